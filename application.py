@@ -1,96 +1,833 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import time
+
+# Start of the boot, for the startup profile. Taken before the other imports,
+# which are a good part of it.
+BOOT_START = time.perf_counter()
+
+import os
+import sys
+import glob
+import threading
+import shutil
+import hashlib
+import re
+import io
+import fcntl
+import mmap
+import traceback
+import zlib
+import queue
+import functools
+import importlib.util
+import concurrent.futures
+import bisect
+import unicodedata
+import gzip
+import brotli
 import dash
 import requests
 import pandas as pd
 import numpy as np
 import json
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
-from dash.dependencies import Input, Output, State
-from datetime import datetime
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
+from pandas.core.internals import BlockManager, make_block
+from datetime import datetime, timedelta
+from collections import OrderedDict
 
 pd.set_option('mode.chained_assignment', None)
 
-URL_DATA = 'https://data.brasil.io/dataset/covid19/caso_full.csv.gz'
+URL_DATA = os.environ.get('BRASHBOARD_DATA_URL', 'https://data.brasil.io/dataset/covid19/caso_full.csv.gz')
+CACHE_DIR = os.environ.get('BRASHBOARD_CACHE_DIR', './cache')
+CACHE_FORMAT = 5
+SHARED_DATA = os.environ.get('BRASHBOARD_SHARED_DATA') == '1'
 URL_GITHUB = 'https://github.com/leonardokume/brashboard'
 LOGO = './assets/logo.png'
 GITHUB_LOGO = 'https://github.githubassets.com/images/modules/logos_page/GitHub-Logo.png'
 POP_BR = 210147125
 STATES = pd.read_csv('./dados/states_ibge_codes.csv')
+# Row and column of each state in the tile map, about where it lies in the country
+STATES_GRID = pd.read_csv('./dados/states_grid.csv')
 MAVG_WINDOW = 14
-
-def download_data():
-    r = requests.get(URL_DATA, stream=True)
-    df = []
+RESPONSE_CACHE_SIZE = int(os.environ.get('BRASHBOARD_RESPONSE_CACHE_SIZE', '256'))
+API_CACHE_SIZE = int(os.environ.get('BRASHBOARD_API_CACHE_SIZE', '256'))
+WARMUP_PLACES = int(os.environ.get('BRASHBOARD_WARMUP_PLACES', '0'))
+REFRESH_INTERVAL = int(os.environ.get('BRASHBOARD_REFRESH_INTERVAL', '0'))
+INCREMENTAL_REFRESH = os.environ.get('BRASHBOARD_INCREMENTAL_REFRESH') == '1'
+CLIENTSIDE_FIGURES = os.environ.get('BRASHBOARD_CLIENTSIDE_FIGURES') == '1'
+RENDER_THREADS = int(os.environ.get('BRASHBOARD_RENDER_THREADS', '0'))
+RENDER_QUEUE = int(os.environ.get('BRASHBOARD_RENDER_QUEUE', '8'))
+METRICS = os.environ.get('BRASHBOARD_METRICS') == '1'
+DOWNSAMPLE_POINTS = int(os.environ.get('BRASHBOARD_DOWNSAMPLE_POINTS', '500'))
+BACKGROUND_LOAD = os.environ.get('BRASHBOARD_BACKGROUND_LOAD') == '1' and not SHARED_DATA
+PROFILE_STARTUP = os.environ.get('BRASHBOARD_PROFILE_STARTUP') == '1'
+INGEST_CHUNK_ROWS = int(os.environ.get('BRASHBOARD_INGEST_CHUNK_ROWS', '5000'))
+INGEST_READ_SIZE = 1 << 16
+INGEST_QUEUE_BLOCKS = 16
+
+# In-memory schema of the dataset. Counts are plain int32 rather than nullable
+# Int32, whose masks slow down reductions and groupbys. Only city_ibge_code
+# (rows not assigned to a city) and estimated_population have nulls, and they
+# are stored as 0, which is neither a valid IBGE code nor a population.
+# Dates are datetime64 and the repeated labels are categories.
+SCHEMA = {
+    'city': 'category',
+    'city_ibge_code': 'int32',
+    'date': 'datetime64[ns]',
+    'epidemiological_week': 'int32',
+    'estimated_population': 'int32',
+    'is_last': 'bool',
+    'last_available_confirmed': 'int32',
+    'last_available_deaths': 'int32',
+    'place_type': 'category',
+    'state': 'category',
+    'new_confirmed': 'int32',
+    'new_deaths': 'int32',
+}
+
+# Duration of each phase of the boot, in order, reported by /ready
+STARTUP_PHASES = OrderedDict()
+STARTUP = {'last': BOOT_START, 'error': None}
+READY = threading.Event()
+
+def mark_startup(phase):
+    """Records the time since the previous phase of the boot as the duration of a phase"""
+    now = time.perf_counter()
+    STARTUP_PHASES[phase] = now - STARTUP['last']
+    STARTUP['last'] = now
+
+mark_startup('imports')
+
+# Opt-in timings of the stages of the request path, as Prometheus histograms
+# served on /metrics. When disabled, timed() returns the functions unchanged.
+METRICS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+STAGE_TIMES = {}
+STAGE_LOCK = threading.Lock()
+
+def record_time(stage, seconds):
+    """Adds the duration of a stage to its histogram"""
+    with STAGE_LOCK:
+        times = STAGE_TIMES.setdefault(stage, {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0})
+        bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        if(bucket < len(METRICS_BUCKETS)):
+            times['buckets'][bucket] += 1
+        times['sum'] += seconds
+        times['count'] += 1
+
+def timed(stage):
+    """Returns a decorator that records the duration of every call of a function when metrics are enabled"""
+    def decorator(func):
+        if(not METRICS):
+            return(func)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return(func(*args, **kwargs))
+            finally:
+                record_time(stage, time.perf_counter() - begin)
+        return(wrapper)
+    return(decorator)
+
+def get_source_path(url):
+    """Returns the local file path of a data source, or None for remote URLs"""
+    if(url.startswith('file://')):
+        return(url[len('file://'):])
+    if('://' not in url):
+        return(url)
+    return(None)
+
+def get_data_version(url):
+    """Returns a string identifying the current version of the data source"""
+    path = get_source_path(url)
+    try:
+        if(path is not None):
+            stat = os.stat(path)
+            return('{}-{}'.format(int(stat.st_mtime), stat.st_size))
+        r = requests.head(url, allow_redirects=True, timeout=10)
+        r.raise_for_status()
+    except (OSError, requests.RequestException):
+        # Offline or missing source, any cached copy will have to do
+        return(None)
+    return(r.headers.get('ETag') or r.headers.get('Last-Modified'))
+
+def open_source(url):
+    """Returns a binary stream with the gzipped CSV of a data source"""
+    path = get_source_path(url)
+    if(path is not None):
+        return(open(path, 'rb'))
+    # The timeout applies to each read, a stalled download fails instead of hanging
+    r = requests.get(url, stream=True, timeout=60)
+    r.raise_for_status()
+    return(r.raw)
+
+# The ingest is a two stage pipeline. A thread reads the source and inflates
+# the gzip stream (both release the GIL) while the calling thread parses the
+# CSV in large chunks. Parsed chunks are copied straight into preallocated
+# column blocks laid out like the cache, so there is no final concat, and the
+# frame is assembled from the blocks without another copy.
+class QueueReader(io.RawIOBase):
+    """Readable stream over the byte blocks put in a queue, an empty block ends it"""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.pending = memoryview(b'')
+        self.done = False
+
+    def readable(self):
+        return(True)
+
+    def readinto(self, buffer):
+        while(not self.pending and not self.done):
+            block = self.blocks.get()
+            if(isinstance(block, Exception)):
+                raise block
+            self.done = not block
+            self.pending = memoryview(block)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return(size)
+
+def inflate_source(source, blocks):
+    """Reads a gzipped stream and puts its inflated contents in a queue"""
+    try:
+        with source:
+            inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            while(True):
+                raw = source.read(INGEST_READ_SIZE)
+                if(not raw):
+                    break
+                while(raw):
+                    # Bounded output, so the queue holds at most 1MB
+                    data = inflater.decompress(raw, INGEST_READ_SIZE)
+                    if(data):
+                        blocks.put(data)
+                    if(not inflater.eof):
+                        raw = inflater.unconsumed_tail
+                    elif(inflater.unused_data):
+                        # A gzip file may hold several members back to back
+                        raw = inflater.unused_data
+                        inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    else:
+                        raw = b''
+            data = inflater.flush()
+            if(data):
+                blocks.put(data)
+    except Exception as e:
+        blocks.put(e)
+    blocks.put(b'')
+
+def get_ingest_layout():
+    """Returns the column descriptions and block shapes of a freshly ingested dataset"""
+    columns = []
+    shapes = {}
+    for name, t in SCHEMA.items():
+        kind = 'category' if t == 'category' else t
+        block = get_cache_block(name, kind)
+        # Labels are coded as int16, widened if a column ever has more of them
+        dtype = 'int16' if kind == 'category' else t
+        rows, _ = shapes.get(block, (0, dtype))
+        columns.append({'name': name, 'kind': kind, 'block': block, 'row': rows})
+        shapes[block] = (rows + 1, dtype)
+    return(columns, shapes)
+
+def encode_labels(values, labels):
+    """Returns the codes of a categorical chunk in a dictionary of labels shared by every chunk"""
+    mapping = [labels.setdefault(label, len(labels)) for label in values.cat.categories]
+    # Code -1 marks a null and picks the trailing -1
+    return(np.array(mapping + [-1], dtype='int32')[values.cat.codes.to_numpy()])
+
+def sort_labels(codes, labels):
+    """Returns the codes and categories of a column with the categories in sorted order"""
+    categories = np.array(list(labels), dtype=object)
+    order = np.argsort(categories, kind='mergesort')
+    rank = np.empty(len(order) + 1, dtype='int32')
+    rank[order] = np.arange(len(order), dtype='int32')
+    # Code -1 picks the trailing -1 again
+    rank[-1] = -1
+    codes = rank[codes]
+    # Same code width pandas picks for the number of categories
+    width = 'int8' if len(order) < 127 else 'int16' if len(order) < 32767 else 'int32'
+    return(codes.astype(width), [str(c) for c in categories[order]])
+
+def get_buffer(dtype, rows):
+    """Returns an empty column of some rows in its own anonymous memory map"""
+    # Unlike the heap, a memory map goes back to the system as soon as the
+    # column is freed, and its pages are only taken as rows are written
+    dtype = np.dtype(dtype)
+    return(np.frombuffer(mmap.mmap(-1, max(rows, 1) * dtype.itemsize), dtype=dtype))
+
+def download_data(url=URL_DATA, source=None, since=None):
+    """Returns the dataset parsed from a data source
+
+    since optionally maps IBGE codes to dates, as a Series, and then only the
+    rows of each place dated after its own date are kept, with every row of
+    the places not in it.
+    """
+    if(source is None):
+        source = open_source(url)
+    columns, shapes = get_ingest_layout()
+    capacity = INGEST_CHUNK_ROWS
+    buffers = {c['name']: get_buffer(shapes[c['block']][1], capacity) for c in columns}
+    labels = {c['name']: {} for c in columns if c['kind'] == 'category'}
+
+    inflated = queue.Queue(maxsize=INGEST_QUEUE_BLOCKS)
+    threading.Thread(target=inflate_source, args=(source, inflated), daemon=True).start()
+    # Integers are parsed as floats, with NaN for the nulls, which is several
+    # times faster than the nullable Int32 parser. Dates are parsed as labels,
+    # so only the few distinct ones of a chunk become strings and dates.
+    dtype = {col: 'float64' if t == 'int32' else 'category' for col, t in SCHEMA.items() if t != 'bool'}
+    n = 0
     for chunk in pd.read_csv(
-        r.raw, compression='gzip', header=0, sep=',', quotechar='"', chunksize=5000,
-            dtype={
-            'city':'category',
-            'place_type':'category',
-            'state':'category',
-            'city_ibge_code':'Int32',
-            'epidemiological_week':'Int32',
-            'estimated_population':'Int32',
-            'last_available_confirmed':'Int32',
-            'last_available_deaths':'Int32',
-            'new_confirmed':'Int32',
-            'new_deaths':'Int32',
-        },
-        usecols=[
-            'city',
-            'date',
-            'city_ibge_code',
-            'epidemiological_week',
-            'estimated_population',
-            'is_last',
-            'last_available_confirmed',
-            'last_available_deaths',
-            'place_type',
-            'state',
-            'new_confirmed',
-            'new_deaths'
-        ]):
-        df.append(chunk)
-    df = pd.concat(df)
+        io.BufferedReader(QueueReader(inflated), INGEST_READ_SIZE), header=0, sep=',', quotechar='"',
+        chunksize=INGEST_CHUNK_ROWS, dtype=dtype, usecols=list(SCHEMA)):
+        # Rows without an IBGE code are not shown anywhere
+        keep = chunk['city_ibge_code'].fillna(0).to_numpy() != 0
+        if(since is not None):
+            # Places lag behind each other, each one has its own cutoff
+            cutoff = chunk['city_ibge_code'].map(since).to_numpy(dtype='datetime64[ns]')
+            keep &= np.isnat(cutoff) | (compact_values(chunk['date'], 'datetime64[ns]') > cutoff)
+        size = int(keep.sum())
+        if(n + size > capacity):
+            # Columns grow one at a time, so only one of them is ever copied
+            capacity = max(2 * capacity, n + size)
+            for name, values in buffers.items():
+                buffers[name] = get_buffer(values.dtype, capacity)
+                buffers[name][:n] = values[:n]
+                del values
+        # Columns are converted and copied one at a time, the chunk itself is never filtered
+        for column in columns:
+            values = compact_values(chunk[column['name']], column['kind'], labels.get(column['name']))
+            if(column['kind'] == 'category' and len(labels[column['name']]) > np.iinfo(buffers[column['name']].dtype).max):
+                buffers[column['name']] = buffers[column['name']].astype('int32')
+            buffers[column['name']][n:n + size] = values if size == len(keep) else values[keep]
+        n += size
+
+    # Rows of a place are kept contiguous and in date order, see build_index.
+    # Each column is moved into its block in that order and its buffer freed,
+    # so the blocks take the place of the buffers as they are filled.
+    order = np.lexsort((buffers['date'][:n], buffers['city_ibge_code'][:n]))
+    blocks = {}
+    for column in columns:
+        values = buffers.pop(column['name'])
+        rows, dtype = shapes[column['block']]
+        if(column['block'] not in blocks):
+            blocks[column['block']] = np.empty((rows, n), dtype=values.dtype if column['kind'] == 'category' else dtype)
+        # Any mode but 'raise' writes straight into the block instead of a copy
+        np.take(values[:n], order, out=blocks[column['block']][column['row']], mode='clip')
+        del values
+        if(column['kind'] == 'category'):
+            codes, column['categories'] = sort_labels(blocks[column['block']][0], labels[column['name']])
+            blocks[column['block']] = codes.reshape(1, -1)
+    return(build_frame({'rows': n, 'columns': columns}, blocks))
+
+def compact_values(values, kind, labels=None):
+    """Returns a parsed column of a chunk with the values of the dataset schema, cast when copied into its buffer"""
+    if(kind == 'int32'):
+        # Nulls are stored as 0, see SCHEMA. The chunk is not used again, so
+        # its floats are changed in place.
+        values = values.to_numpy()
+        values[np.isnan(values)] = 0
+        return(values)
+    if(kind == 'category'):
+        return(encode_labels(values, labels))
+    if(kind == 'bool'):
+        return(values.fillna(False).to_numpy(dtype='bool'))
+    # Code -1 marks a null and picks the trailing NaT
+    dates = pd.to_datetime(values.cat.categories, format='%Y-%m-%d').to_numpy()
+    return(np.append(dates, np.datetime64('NaT', 'ns'))[values.cat.codes.to_numpy()])
+
+def get_memory_report(df):
+    """Returns the dtype, size in bytes and bytes per row of every column of the dataset"""
+    usage = df.memory_usage(index=False, deep=True)
+    rows = max(len(df), 1)
+    report = pd.DataFrame({'dtype': df.dtypes.astype(str), 'bytes': usage, 'bytes_per_row': usage / rows})
+    report.loc['total'] = ['', usage.sum(), usage.sum() / rows]
+    return(report)
+
+def sort_data(df):
+    """Returns the dataset with categorical labels and the rows sorted by place and date"""
+    # Frames with different categories concatenate into object columns
+    for col in ['city', 'place_type', 'state']:
+        df[col] = df[col].astype('category')
+    # Rows of a place are kept contiguous and in date order, see build_index
+    df = df.sort_values(by=['city_ibge_code', 'date'], kind='mergesort', ignore_index=True)
+    return(df)
+
+# The cache keeps one directory per data version. Columns are grouped by dtype
+# into 2D blocks (one .npy file per block, one row per column), mirroring the
+# pandas block layout. Reloading it is a plain memory read instead of a CSV
+# parse, and with BRASHBOARD_SHARED_DATA the blocks are memory-mapped so every
+# worker process shares the same physical pages.
+def get_cache_path(version):
+    """Returns the cache directory for a data version"""
+    key = '{}:{}'.format(CACHE_FORMAT, version).encode('utf-8')
+    return(os.path.join(CACHE_DIR, 'caso_full-' + hashlib.sha1(key).hexdigest()[:16]))
+
+def find_cache(version):
+    """Returns the path of a complete cache for a data version, or the newest one if the version is unknown"""
+    if(version is not None):
+        path = get_cache_path(version)
+        return(path if os.path.exists(os.path.join(path, 'meta.json')) else None)
+    metas = glob.glob(os.path.join(CACHE_DIR, 'caso_full-*', 'meta.json'))
+    metas = [m for m in metas if '.tmp' not in m]
+    if(not metas):
+        return(None)
+    return(os.path.dirname(max(metas, key=os.path.getmtime)))
+
+def encode_column(series):
+    """Returns the column kind, its values and an optional null mask or category list"""
+    if(pd.api.types.is_extension_array_dtype(series.dtype) and pd.api.types.is_integer_dtype(series.dtype)):
+        values = series.to_numpy(dtype='int32', na_value=0)
+        return('Int32', values, series.isna().to_numpy())
+    if(pd.api.types.is_bool_dtype(series.dtype) or pd.api.types.is_numeric_dtype(series.dtype) or pd.api.types.is_datetime64_dtype(series.dtype)):
+        return(series.dtype.name, series.to_numpy(), None)
+    kind = 'category' if pd.api.types.is_categorical_dtype(series.dtype) else 'string'
+    series = series.astype('category')
+    return(kind, series.cat.codes.to_numpy(), [str(c) for c in series.cat.categories])
+
+def get_cache_block(name, kind):
+    """Returns the name of the cache block that stores a column"""
+    if(kind in ('category', 'string')):
+        # Codes keep the integer width pandas picks, so they load without a cast
+        return(name + '.codes')
+    # Plain dtype names such as datetime64[ns] turn into file names
+    return(re.sub(r'\W', '', kind))
+
+def write_cache(df, version, key=None):
+    """Writes a dataframe to the cache directory of a data version, or of another key for data that is not the upstream file"""
+    path = get_cache_path(version if key is None else key)
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    meta = {'version': version, 'rows': len(df), 'columns': [], 'blocks': []}
+    blocks = {}
+    for name in df.columns:
+        kind, values, extra = encode_column(df[name])
+        block = get_cache_block(name, kind)
+        column = {'name': name, 'kind': kind, 'block': block, 'row': len(blocks.setdefault(block, []))}
+        blocks[block].append(values)
+        if(kind == 'Int32'):
+            column['mask_row'] = len(blocks.setdefault('mask', []))
+            blocks['mask'].append(extra)
+        elif(extra is not None):
+            column['categories'] = extra
+        meta['columns'].append(column)
+    for block, arrays in blocks.items():
+        np.save(os.path.join(tmp, block + '.npy'), np.stack(arrays))
+        meta['blocks'].append(block)
+    # meta.json is written last, a cache directory without it is incomplete
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another worker finished writing the same version first
+        shutil.rmtree(tmp, ignore_errors=True)
+    for old in glob.glob(os.path.join(CACHE_DIR, 'caso_full-*')):
+        if(old != path and '.tmp' not in old):
+            shutil.rmtree(old, ignore_errors=True)
+    return(path)
+
+def read_cache(path, mmap=SHARED_DATA):
+    """Returns the dataframe stored in a cache directory and its version, optionally backed by memory maps"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    blocks = {}
+    for block in meta['blocks']:
+        # Copy-on-write maps, since pandas' Cython routines reject read-only
+        # buffers. Nothing writes to them, so the pages are never duplicated.
+        blocks[block] = np.asarray(np.load(os.path.join(path, block + '.npy'), mmap_mode='c' if mmap else None))
+    return(build_frame(meta, blocks), meta['version'])
+
+def build_frame(meta, blocks):
+    """Returns a dataframe assembled from column blocks laid out as in the cache"""
+    # The frame is assembled from blocks directly, the DataFrame constructor
+    # would stack the plain columns into new arrays and break the sharing
+    frame_blocks = []
+    plain = {}
+    for i, column in enumerate(meta['columns']):
+        values = blocks[column['block']][column['row']]
+        if(column['kind'] == 'Int32'):
+            values = pd.arrays.IntegerArray(values, blocks['mask'][column['mask_row']])
+        elif(column['kind'] == 'category'):
+            values = pd.Categorical.from_codes(values, categories=column['categories'])
+        elif(column['kind'] == 'string'):
+            # Code -1 marks a null and picks the trailing NaN
+            values = np.append(np.array(column['categories'], dtype=object), np.nan)[values]
+            values = values.reshape(1, -1)
+        else:
+            plain.setdefault(column['block'], []).append(i)
+            continue
+        frame_blocks.append(make_block(values, placement=[i], ndim=2))
+    for block, placement in plain.items():
+        frame_blocks.append(make_block(blocks[block], placement=placement, ndim=2))
+    columns = pd.Index([c['name'] for c in meta['columns']])
+    return(pd.DataFrame(BlockManager(frame_blocks, [columns, pd.RangeIndex(meta['rows'])])))
+
+@timed('moving_average')
+def moving_average(data, window, stops=None):
+    """Returns the mean of each row and the window - 1 rows after it, the window shrinks at the tail
+
+    A 2D input (or a dataframe) averages each column independently. Nulls are
+    skipped, and a window with nulls only averages to NaN. With stops, the
+    window of row i also shrinks to end before row stops[i], which keeps the
+    windows of several series stacked in one array from overlapping.
+    """
+    if(isinstance(data, (pd.Series, pd.DataFrame))):
+        values = data.astype('float64').to_numpy()
+    else:
+        values = np.asarray(data, dtype='float64')
+    shape = values.shape
+    values = values.reshape(len(values), int(np.prod(shape[1:])))
+    valid = ~np.isnan(values)
+    # Window sums are differences of cumulative sums, exact for integer counts
+    sums = np.zeros((len(values) + 1, values.shape[1]))
+    sums[1:] = np.cumsum(np.where(valid, values, 0), axis=0)
+    counts = np.zeros(sums.shape)
+    counts[1:] = np.cumsum(valid, axis=0)
+    start = np.arange(len(values))
+    stop = np.minimum(start + window, len(values) if stops is None else stops)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mov_avg = (sums[stop] - sums[start]) / (counts[stop] - counts[start])
+    return(mov_avg.reshape(shape))
+
+def get_place_bounds(df):
+    """Returns the IBGE codes of the rows and the start and stop positions of each place"""
+    codes = df['city_ibge_code'].to_numpy(dtype='int64')
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    stops = np.r_[starts[1:], len(codes)]
+    return(codes, starts, stops)
+
+def add_derived_columns(df):
+    """Adds the moving averages of every place to the dataset, computed in a single pass"""
+    codes, starts, stops = get_place_bounds(df)
+    mov_avg = moving_average(df[['new_confirmed', 'new_deaths']], MAVG_WINDOW, stops=np.repeat(stops, stops - starts))
+    df['cases_moving_average'] = mov_avg[:, 0].astype('float32')
+    df['deaths_moving_average'] = mov_avg[:, 1].astype('float32')
     return(df)
 
-DF = download_data()
-CITIES = DF[["city", "city_ibge_code", "place_type", "state"]].drop_duplicates().sort_values(by="city").dropna()
-CITIES = CITIES.loc[CITIES["place_type"] == "city"]
-CITIES = CITIES.rename(columns={"city":"label", "city_ibge_code":"value"})
+def get_load_version():
+    """Returns the version of a copy of the data whose upstream version is unknown, told apart by its load time"""
+    return('loaded-{:%Y%m%dT%H%M%S}'.format(datetime.now()))
+
+def store_data(df, version):
+    """Writes a freshly parsed dataset to the cache, returns it and its version"""
+    if(version is None):
+        return(df, get_load_version())
+    path = write_cache(df, version)
+    if(SHARED_DATA):
+        # Drop the private copy in favour of the shared memory map
+        return(read_cache(path))
+    return(df, version)
+
+@timed('load_data')
+def load_data(url=URL_DATA):
+    """Returns the dataset and its version, reading it from the local cache when it is up to date"""
+    version = get_data_version(url)
+    path = find_cache(version)
+    if(path is not None):
+        return(read_cache(path))
+    try:
+        df = add_derived_columns(download_data(url))
+    except (OSError, zlib.error, pd.errors.ParserError, pd.errors.EmptyDataError, requests.RequestException):
+        # Source unreachable or not a valid dataset, fall back to a stale cache if there is one
+        path = find_cache(None)
+        if(path is None):
+            raise
+        return(read_cache(path))
+    return(store_data(df, version))
+
+def build_index(df):
+    """Returns dictionaries mapping each IBGE code to the slice of its rows and to the position of its last row"""
+    codes, starts, stops = get_place_bounds(df)
+    index = {int(codes[start]): slice(start, stop) for start, stop in zip(starts, stops) if codes[start] != 0}
+    last = {int(codes[pos]): pos for pos in np.flatnonzero(df['is_last'].to_numpy()) if codes[pos] != 0}
+    return(index, last)
+
+def build_places(df):
+    """Returns a dataframe indexed by IBGE code with the indicators of every place
+
+    Weekly sums come from one reduceat over the (place, week) runs of the
+    sorted dataset, the rest from the first and last row of each place.
+    The current week is the last complete one, the last week in the
+    dataset is still running.
+    """
+    codes, starts, stops = get_place_bounds(df)
+    weeks = df['epidemiological_week'].to_numpy(dtype='int64')
+    new = df[['new_confirmed', 'new_deaths']].to_numpy(dtype='float64')
+    week_starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1]) | (weeks[1:] != weeks[:-1])])
+    week_new = np.add.reduceat(new, week_starts, axis=0)
+    # Position of the last week of each place, and how many weeks it has
+    last_week = np.searchsorted(week_starts, stops, side='left') - 1
+    n_weeks = last_week - np.searchsorted(week_starts, starts, side='left') + 1
+    current = np.where(n_weeks >= 2, week_new[last_week - 1, 0], np.nan)
+    previous = np.where(n_weeks >= 3, week_new[last_week - 2, 0], np.nan)
+    current_deaths = np.where(n_weeks >= 2, week_new[last_week - 1, 1], np.nan)
+
+    is_last = df['is_last'].to_numpy()
+    last_rows = np.flatnonzero(is_last)
+    deaths = pd.Series(df['last_available_deaths'].to_numpy(dtype='float64')[last_rows], index=codes[last_rows])
+    confirmed = pd.Series(df['last_available_confirmed'].to_numpy(dtype='float64')[last_rows], index=codes[last_rows])
+    # A population of 0 stands for a missing one
+    population = df['estimated_population'].to_numpy(dtype='float64')[starts]
+
+    places = pd.DataFrame({
+        'population': np.where(population > 0, population, np.nan),
+        'growth_current': current,
+        'growth_last': previous,
+        'deaths_current': current_deaths,
+    }, index=codes[starts])
+    places = places.loc[places.index != 0]
+    places['deaths'] = deaths.loc[~deaths.index.duplicated()].reindex(places.index)
+    places['confirmed'] = confirmed.loc[~confirmed.index.duplicated()].reindex(places.index)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        places['growth_current'] = places['growth_current'] / places['population'] * 100000
+        places['growth_last'] = places['growth_last'] / places['population'] * 100000
+        places['deaths_current'] = places['deaths_current'] / places['population'] * 100000
+        places['mortality'] = places['deaths'] / places['population'] * 100000
+        places['letality'] = places['deaths'] / places['confirmed'] * 100
+    return(places)
+
+def build_cities(df):
+    """Returns a dataframe with the label, IBGE code and state of every city"""
+    cities = df[["city", "city_ibge_code", "place_type", "state"]].drop_duplicates().sort_values(by="city").dropna()
+    cities = cities.loc[(cities["place_type"] == "city") & (cities["city_ibge_code"] != 0)]
+    cities = cities.rename(columns={"city":"label", "city_ibge_code":"value"})
+    return(cities)
+
+def build_options(cities):
+    """Returns a dictionary mapping each state IBGE code to the dropdown options of its cities"""
+    options = {int(value): [] for value in STATES['value']}
+    codes = dict(zip(STATES['state'], STATES['value']))
+    for label, value, state in zip(cities['label'], cities['value'], cities['state']):
+        options[int(codes[state])].append({'label': label, 'value': int(value)})
+    return(options)
+
+def build_labels(cities):
+    """Returns a dictionary mapping each IBGE code to the label of its place"""
+    labels = {int(value): label for label, value in zip(STATES['label'], STATES['value'])}
+    for label, value, state in zip(cities['label'], cities['value'], cities['state']):
+        labels[int(value)] = '{} ({})'.format(label, state)
+    return(labels)
+
+def build_city_states(cities):
+    """Returns a dictionary mapping each city IBGE code to the abbreviation of its state"""
+    return({int(value): str(state) for value, state in zip(cities['value'], cities['state'])})
+
+def get_search_key(name):
+    """Returns a name in lower case and without accents, as the city search compares them"""
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return(name.lower().strip())
+
+def build_search(cities):
+    """Returns the search keys of every city in sorted order and the cities in the same order"""
+    entries = sorted(
+        (get_search_key(label), label, int(value), state)
+        for label, value, state in zip(cities['label'], cities['value'], cities['state'])
+    )
+    keys = [entry[0] for entry in entries]
+    places = [{'label': label, 'value': value, 'state': state} for _, label, value, state in entries]
+    return({'keys': keys, 'places': places})
+
+# Indicators cities are ranked by, all of them higher is worse
+RANKING_METRICS = [
+    ('growth_current', 'Casos por 100 mil habitantes na última semana'),
+    ('deaths_current', 'Óbitos por 100 mil habitantes na última semana'),
+    ('mortality', 'Óbitos por 100 mil habitantes'),
+    ('letality', 'Taxa de letalidade'),
+]
+
+def build_ranking(codes, values):
+    """Returns IBGE codes and values sorted from the highest value down, ties by code, with the rank of each code"""
+    order = np.lexsort((codes, -values))
+    return({
+        'codes': codes[order],
+        'values': values[order],
+        'ranks': dict(zip(codes[order].tolist(), range(1, len(order) + 1))),
+    })
+
+def build_rankings(places, cities):
+    """Returns, for each ranked indicator, the cities sorted in the whole country (key None) and in each state
+
+    Cities without the indicator, such as the ones without a population,
+    are left out.
+    """
+    cities = cities.drop_duplicates(subset='value')
+    codes = cities['value'].to_numpy(dtype='int64')
+    states = cities['state'].astype(str).to_numpy()
+    rankings = {}
+    for metric, _ in RANKING_METRICS:
+        values = places[metric].reindex(codes).to_numpy(dtype='float64')
+        valid = np.isfinite(values)
+        ranking = {None: build_ranking(codes[valid], values[valid])}
+        for state in np.unique(states[valid]):
+            ranked = valid & (states == state)
+            ranking[state] = build_ranking(codes[ranked], values[ranked])
+        rankings[metric] = ranking
+    return(rankings)
+
+def get_weeks_in_year(year):
+    """Returns the number of epidemiological weeks of a year, 52 or 53
+
+    Weeks run from Sunday to Saturday, and week 1 is the one holding the
+    4th of January.
+    """
+    def first_day(year):
+        jan4 = datetime(year, 1, 4)
+        return(jan4 - timedelta(days=(jan4.weekday() + 1) % 7))
+    return((first_day(year + 1) - first_day(year)).days // 7)
+
+def build_calendar(df):
+    """Returns every epidemiological week from the first one of the first year in the dataset up to its last week
+
+    Weeks are kept as YYYYWW codes, as in the dataset, with their year and
+    zero-padded week number as the histogram labels.
+    """
+    weeks = df['epidemiological_week'].to_numpy()
+    weeks = weeks[weeks > 0]
+    first, last = int(weeks.min()), int(weeks.max())
+    years, numbers = [], []
+    for year in range(first // 100, last // 100 + 1):
+        n = get_weeks_in_year(year)
+        years.extend([year] * n)
+        numbers.extend(range(1, n + 1))
+    years = np.array(years, dtype='int64')
+    numbers = np.array(numbers, dtype='int64')
+    codes = years * 100 + numbers
+    keep = codes <= last
+    return({
+        'codes': codes[keep],
+        'years': years[keep],
+        'weeks': np.array(['{:02d}'.format(n) for n in numbers[keep]], dtype=object),
+    })
+
+def build_national(df):
+    """Returns the national data by date and by epidemiological week, summed over the states
+
+    City rows are left out, they are already counted in their state.
+    """
+    states = df.loc[df['place_type'] == 'state']
+    columns = ['last_available_confirmed', 'last_available_deaths', 'new_confirmed', 'new_deaths']
+    br_date = pd.DataFrame({col: states[col].to_numpy(dtype='int64') for col in columns})
+    br_date['date'] = states['date'].to_numpy()
+    br_date['epidemiological_week'] = states['epidemiological_week'].to_numpy(dtype='int64')
+    br_date = br_date.groupby(['date', 'epidemiological_week'])[columns].sum().reset_index()
+    # Reversed, so the windows run back in time from each day
+    mov_avg = moving_average(br_date[['new_confirmed', 'new_deaths']].to_numpy()[::-1], MAVG_WINDOW)[::-1]
+    br_date['cases_moving_average'] = mov_avg[:, 0]
+    br_date['deaths_moving_average'] = mov_avg[:, 1]
+    br_ew = br_date.groupby(['epidemiological_week'])[['new_confirmed', 'new_deaths']].sum().reset_index()
+    return(br_date, br_ew)
+
+# Everything derived from one version of the dataset lives in a single
+# dictionary, so a refresh swaps all of it with one assignment to DATA.
+# Requests take DATA once and pass it down, so they never mix two versions.
+@timed('build_dataset')
+def build_dataset(df, version):
+    """Returns the dataset with every structure derived from it"""
+    index, last = build_index(df)
+    cities = build_cities(df)
+    places = build_places(df)
+    br_date, br_ew = build_national(df)
+    return({
+        'df': df,
+        'version': version,
+        # Publications of the refreshing process older than this are stale
+        'loaded': time.time(),
+        'index': index,
+        'last': last,
+        'places': places,
+        'rankings': build_rankings(places, cities),
+        'options': build_options(cities),
+        'labels': build_labels(cities),
+        'city_states': build_city_states(cities),
+        'search': build_search(cities),
+        'calendar': build_calendar(df),
+        'br_date': br_date,
+        'br_ew': br_ew,
+    })
+
+# Loaded by start_app once the app is built, see the end of the module
+DATA = None
 
 def get_dropdown_states():
     """Returns a dictionary with states labels and IBGE codes"""
     dropdown = STATES.drop(labels=['state'], axis=1).to_dict('records')
     return(dropdown)
 
-def get_dropdown_cities(state):
+def get_dropdown_cities(state, data):
     """Returns a dictionary with cities labels and IBGE codes"""
-    state_abr = STATES.loc[STATES['value']==state].state.item()
-    state_cities = CITIES.loc[CITIES['state']==state_abr]
-    dropdown = state_cities.drop(labels=['place_type', 'state'], axis=1).to_dict('records')
-    return(dropdown)
-
-def get_ibge_label(ibge_code, type):
-    """Returns a string containing the label from an IBGE code"""
-    if(type == 'city'):
-        label = CITIES.loc[CITIES['value'] == int(ibge_code)].label.item()
-        label = '{} ({})'.format(label, CITIES.loc[CITIES['value'] == int(ibge_code)].state.item())
+    return(data['options'].get(int(state), []))
+
+CITY_OPTIONS_LIMIT = 20
+
+def get_city_options(query, state, selected, data):
+    """Returns the options of the city dropdown, the selected city first, then the cities of a state matching a query"""
+    # Kept even if it does not match, or the dropdown would not show it
+    options = [option for option in get_dropdown_cities(state, data) if option['value'] == selected]
+    key = get_search_key(query or '')
+    if(key):
+        abbr = STATES.loc[STATES['value'] == int(state), 'state'].item()
+        matches = search_cities(key, data, state=abbr, limit=CITY_OPTIONS_LIMIT)
     else:
-        label = STATES.loc[STATES['value'] == int(ibge_code)].label.item()
-    return(label)
-
-def get_data(ibge_code):
+        # The first cities of the state, already in order
+        matches = get_dropdown_cities(state, data)[:CITY_OPTIONS_LIMIT]
+    for place in matches:
+        if(place['value'] != selected):
+            options.append({'label': place['label'], 'value': place['value']})
+    return(options)
+
+def get_ibge_label(ibge_code, type, data):
+    """Returns a string containing the label from an IBGE code"""
+    return(data['labels'][int(ibge_code)])
+
+def search_cities(query, data, state=None, limit=10):
+    """Returns the cities whose name starts with a query, ignoring case and accents"""
+    search = data['search']
+    key = get_search_key(query)
+    found = []
+    pos = bisect.bisect_left(search['keys'], key)
+    while(len(found) < limit and pos < len(search['keys']) and search['keys'][pos].startswith(key)):
+        place = search['places'][pos]
+        if(state is None or place['state'] == state):
+            found.append(place)
+        pos += 1
+    return(found)
+
+def get_ranking(metric, data, state=None, limit=20, offset=0):
+    """Returns a list of (rank, IBGE code, value) of the cities ranked from offset to offset + limit, in the country or in a state"""
+    ranking = data['rankings'][metric].get(state)
+    if(ranking is None):
+        return([])
+    codes = ranking['codes'][offset:offset + limit].tolist()
+    values = ranking['values'][offset:offset + limit].tolist()
+    return([(offset + i + 1, code, value) for i, (code, value) in enumerate(zip(codes, values))])
+
+def get_rank(ibge_code, metric, data, state=None):
+    """Returns the rank of a city and the number of cities ranked, in the country or in a state, or None if it is not ranked"""
+    ranking = data['rankings'][metric].get(state)
+    rank = None if ranking is None else ranking['ranks'].get(int(ibge_code))
+    return(None if rank is None else (rank, len(ranking['codes'])))
+
+@timed('get_data')
+def get_data(ibge_code, data):
     """Returns a dataframe with the data from an IBGE code"""
-    df = DF.loc[DF['city_ibge_code'] == ibge_code]
-    df['cases_moving_average'] = moving_average(df['new_confirmed'], MAVG_WINDOW)
-    df['deaths_moving_average'] = moving_average(df['new_deaths'], MAVG_WINDOW)
+    df = data['df'].iloc[data['index'][int(ibge_code)]]
     return (df)
 
+def get_date_labels(dates):
+    """Returns the dates as YYYY-MM-DD strings, which keep the figures smaller than full timestamps"""
+    return(np.datetime_as_string(dates.to_numpy(), unit='D'))
+
 def get_br_data():
     """Returns a dataframe with the national data"""
     PARAMS = {'place_type':'state', 'page_size':'10000'}
@@ -100,7 +837,36 @@ def get_br_data():
     df = pd.read_json(json.dumps(data))
     return (df)
 
-def generate_scatter_fig(x, y, type):
+# Time windows of the graphs, in days, 0 for the whole series
+TIME_WINDOWS = [('30 dias', 30), ('90 dias', 90), ('1 ano', 365), ('Tudo', 0)]
+
+def get_window_start(dates, days):
+    """Returns the position of the first row within the last days of a series of dates, 0 for the whole series"""
+    if(not days):
+        return(0)
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    return(int(np.searchsorted(dates, dates[-1] - np.timedelta64(days - 1, 'D'))))
+
+def downsample(y, points=DOWNSAMPLE_POINTS, window=0):
+    """Returns the positions of the points kept of a series of at most a number of points
+
+    The series is cut in buckets, and the minimum and maximum of each one
+    are kept, in order, along with the first and last points. Peaks and
+    valleys stay in place, which an average or a stride would flatten.
+    A series cut to a time window of at most window days is kept whole.
+    """
+    y = np.asarray(y, dtype='float64')
+    if(points <= 0 or len(y) <= max(points, window)):
+        return(np.arange(len(y)))
+    buckets = np.arange(len(y)) * max((points - 2) // 2, 1) // len(y)
+    # Sorted by bucket, then by value, the ends of each bucket are its minimum and maximum
+    order = np.lexsort((y, buckets))
+    first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[first[1:] - 1, len(y) - 1]
+    return(np.unique(np.r_[0, order[first], order[last], len(y) - 1]))
+
+@timed('generate_scatter_fig')
+def generate_scatter_fig(x, y, type, window=0):
     if(type == 'last_available_confirmed'):
         color = '#008cff'
         fcolor = 'rgba(0,140,255,0.3)'
@@ -108,10 +874,16 @@ def generate_scatter_fig(x, y, type):
         color = '#ff0000'
         fcolor = 'rgba(255,0,0,0.3)'
 
+    # Markers on the kept points only would pass them for daily values
+    keep = downsample(y, window=window)
+    mode = 'lines+markers'
+    if(len(keep) < len(y)):
+        x, y, mode = np.asarray(x)[keep], np.asarray(y)[keep], 'lines'
+
     fig = go.Figure(data=[go.Scatter(
                         x=x,
                         y=y,
-                        mode='lines+markers',
+                        mode=mode,
                         line_color=color,
                         fill='tozeroy',
                         fillcolor=fcolor,
@@ -128,7 +900,8 @@ def generate_scatter_fig(x, y, type):
     )
     return(fig)
 
-def generate_bar_fig(x, y, mavg, type):
+@timed('generate_bar_fig')
+def generate_bar_fig(x, y, mavg, type, window=0):
     if(type == 'new_confirmed'):
         color = '#008cff'
         trace_color = '#ff0000'
@@ -136,11 +909,13 @@ def generate_bar_fig(x, y, mavg, type):
         color = '#ff0000'
         trace_color = '#000'
 
+    keep = downsample(y, window=window)
+    keep_mavg = downsample(mavg, window=window)
     fig = go.Figure(data=[go.Bar(
         showlegend=False,
         name='Novos casos',
-        x=x,
-        y=y,
+        x=np.asarray(x)[keep] if len(keep) < len(y) else x,
+        y=np.asarray(y)[keep] if len(keep) < len(y) else y,
         marker_color=color,
         hovertemplate = '%{x}: %{y:.3s}<extra></extra>'
         )]
@@ -148,8 +923,8 @@ def generate_bar_fig(x, y, mavg, type):
 
     fig.add_trace(go.Scatter(
         name='Média móvel (14 dias)',
-        x=x,
-        y=mavg,
+        x=np.asarray(x)[keep_mavg] if len(keep_mavg) < len(mavg) else x,
+        y=np.asarray(mavg)[keep_mavg] if len(keep_mavg) < len(mavg) else mavg,
         marker_color=trace_color,
         hovertemplate = '%{x}: %{y:.3s}<extra></extra>'
     ))
@@ -167,32 +942,32 @@ def generate_bar_fig(x, y, mavg, type):
     )
     return(fig)
 
-def generate_histogram_fig(x, y, type):
+def get_weekly_data(x, y, calendar, first_week=None):
+    """Returns the year and week labels up to the last week in x, and the sums of y in each of those weeks
+
+    The weeks start at the first one of the calendar, or at first_week.
+    """
+    x = np.asarray(x, dtype='int64')
+    pos = np.searchsorted(calendar['codes'], x)
+    # Weeks outside the calendar are left out
+    valid = (pos < len(calendar['codes'])) & (calendar['codes'][np.minimum(pos, len(calendar['codes']) - 1)] == x)
+    n = pos[valid].max() + 1 if valid.any() else 0
+    sums = np.bincount(pos[valid], weights=np.asarray(y, dtype='float64')[valid], minlength=n)
+    first = 0 if first_week is None else int(np.searchsorted(calendar['codes'], first_week))
+    return(calendar['years'][first:n], calendar['weeks'][first:n], sums[first:].astype('int64'))
+
+@timed('generate_histogram_fig')
+def generate_histogram_fig(x, y, type, calendar, first_week=None):
     if(type == 'new_confirmed'):
         color = '#008cff'
     else:
         color = '#ff0000'
 
-    x1 = x.astype(str).str.slice(4, 6)
-    current_ew = int(x1.iloc[-1])
-
-    ew20 = pd.Series([str(x).zfill(2) for x in range(1, 54)])
-    ew21 = pd.Series([str(x).zfill(2) for x in range(1, current_ew+1)])
-    ews = pd.concat([ew20, ew21])
-    y20 = pd.Series([2020]*len(ew20))
-    y21 = pd.Series([2021]*len(ew21))
-    ys = pd.concat([y20, y21])
-    df_ew = pd.DataFrame({"ew":ews, "year":ys})
-    df_ew['ew_int'] = df_ew['year'].astype(str) + df_ew['ew'].astype(str)
-    df_ew['ew_int'] = df_ew['ew_int'].astype(int)
-
-    df_hist = pd.DataFrame({'ew_int':x, 'y':y})
-    df_hist = pd.merge(df_ew, df_hist, how='left', on='ew_int')
-
+    years, weeks, sums = get_weekly_data(x, y, calendar, first_week)
     fig = go.Figure(data=[go.Histogram(
         histfunc="sum",
-        x=[df_hist['year'],df_hist['ew']],
-        y=df_hist['y'].fillna(0),
+        x=[years, weeks],
+        y=sums,
         marker_color=color,
         nbinsx=len(x.unique()),
         autobinx = False,
@@ -213,7 +988,7 @@ def generate_histogram_fig(x, y, type):
     return(fig)
 
 def generate_indicator(data, change, date, type):
-    date = datetime.strptime(date, "%Y-%m-%d")
+    date = pd.Timestamp(date)
     if(type == 'deaths'):
         fig = [
             html.Center(
@@ -283,104 +1058,349 @@ def generate_growth_indicator(data, change):
         ]
     return(fig)
 
-def get_growth_data(df):
-    group_ew = df.groupby(['epidemiological_week'])['new_confirmed'].sum()
-    pop = df['estimated_population'].iloc[0].item()
-    current = (group_ew.iloc[-2].item() / pop) * 100000
-    last = (group_ew.iloc[-3].item() / pop) * 100000
-    return(current, last)
-
-def get_letality_data(df):
-    pop = df['estimated_population'].iloc[0].item()
-    total_deaths = df.loc[df['is_last']==True, 'last_available_deaths'].item()
-    total_confirmed = df.loc[df['is_last']==True, 'last_available_confirmed'].item()
-    mortality =  (total_deaths / pop) * 100000
-    letality = (total_deaths / total_confirmed) * 100
-    return(mortality, letality)
-
-def moving_average(data, window):
-    mov_avg = []
-    for i in range(len(data)):
-        if(i + window > len(data)):
-            mov_avg.append(np.mean(data[i:len(data)]))
-        else:
-            mov_avg.append(np.mean(data[i:i+window]))
-    return(mov_avg)
+@timed('get_growth_data')
+def get_growth_data(ibge_code, data):
+    place = data['places'].loc[int(ibge_code)]
+    return(place['growth_current'], place['growth_last'])
 
-def generate_graphs(ibge_code):
-    df = get_data(ibge_code)
-    # num = df._get_numeric_data()
-    # num[num < 0] = 0
+@timed('get_letality_data')
+def get_letality_data(ibge_code, data):
+    place = data['places'].loc[int(ibge_code)]
+    return(place['mortality'], place['letality'])
+
+def generate_figures(dates, df, ew, calendar, key=None, held=None, window=0):
+    """Returns the six graphs of a place from its daily rows and its rows by epidemiological week
+
+    Only the last window days are shown, and the weeks they fall in.
+    """
+    if(CLIENTSIDE_FIGURES):
+        # The browser builds the graphs, see assets/figures.js
+        return([get_figures_data(dates, df, ew, calendar, key, held)])
+
+    start = get_window_start(df['date'], window)
+    first_week = None
+    if(start > 0):
+        first_week = int(df['epidemiological_week'].iloc[start])
+        dates, df = dates[start:], df.iloc[start:]
+        ew = ew.loc[ew['epidemiological_week'].to_numpy() >= first_week]
 
     childrens = []
 
     cases = dcc.Graph(
-        figure = generate_scatter_fig(x=df['date'], y=df['last_available_confirmed'], type='last_available_confirmed'),
+        figure = generate_scatter_fig(x=dates, y=df['last_available_confirmed'], type='last_available_confirmed', window=window),
         config = {'displayModeBar': False}
     )
     childrens.append(cases)
 
     deaths = dcc.Graph(
-        figure = generate_scatter_fig(x=df['date'], y=df['last_available_deaths'], type='last_available_deaths'),
+        figure = generate_scatter_fig(x=dates, y=df['last_available_deaths'], type='last_available_deaths', window=window),
         config = {'displayModeBar': False}
     )
     childrens.append(deaths)
 
     cases_day = dcc.Graph(
-        figure = generate_bar_fig(x=df['date'], y=df['new_confirmed'], mavg=df['cases_moving_average'], type='new_confirmed'),
+        figure = generate_bar_fig(x=dates, y=df['new_confirmed'], mavg=df['cases_moving_average'], type='new_confirmed', window=window),
         config = {'displayModeBar': False}
     )
     childrens.append(cases_day)
 
     deaths_day = dcc.Graph(
-        figure = generate_bar_fig(x=df['date'], y=df['new_deaths'], mavg=df['deaths_moving_average'], type='new_deaths'),
+        figure = generate_bar_fig(x=dates, y=df['new_deaths'], mavg=df['deaths_moving_average'], type='new_deaths', window=window),
         config = {'displayModeBar': False}
     )
     childrens.append(deaths_day)
 
     cases_week = dcc.Graph(
-        figure = generate_histogram_fig(x=df['epidemiological_week'], y=df['new_confirmed'], type='new_confirmed'),
+        figure = generate_histogram_fig(x=ew['epidemiological_week'], y=ew['new_confirmed'], type='new_confirmed', calendar=calendar, first_week=first_week),
         config = {'displayModeBar': False}
     )
     childrens.append(cases_week)
 
     deaths_week = dcc.Graph(
-        figure = generate_histogram_fig(x=df['epidemiological_week'], y=df['new_deaths'], type='new_deaths'),
+        figure = generate_histogram_fig(x=ew['epidemiological_week'], y=ew['new_deaths'], type='new_deaths', calendar=calendar, first_week=first_week),
         config = {'displayModeBar': False}
     )
     childrens.append(deaths_week)
 
+    return(childrens)
+
+def get_figures_data(dates, df, ew, calendar, key=None, held=None):
+    """Returns the columns the browser builds the six graphs from, each one sent once
+
+    When the browser already holds the first rows of the place, given as
+    (rows, checksum), and they did not change, only the days after them are
+    sent, from the positions in start and week_start on. The moving averages
+    look ahead MAVG_WINDOW days, so the last days held are sent again.
+    """
+    rows = len(dates)
+    start = 0
+    if(held is not None and 0 < held[0] <= rows and get_series_checksum(dates, df, held[0], calendar) == held[1]):
+        start = max(held[0] - (MAVG_WINDOW - 1), 0)
+    week_start = 0
+    if(start > 0):
+        week_start = int(np.searchsorted(calendar['codes'], df['epidemiological_week'].iloc[start]))
+    years, weeks, week_confirmed = get_weekly_data(ew['epidemiological_week'], ew['new_confirmed'], calendar)
+    _, _, week_deaths = get_weekly_data(ew['epidemiological_week'], ew['new_deaths'], calendar)
+    return({
+        'key': key,
+        'rows': rows,
+        'checksum': get_series_checksum(dates, df, rows, calendar),
+        'start': start,
+        'week_start': week_start,
+        'dates': dates[start:].tolist(),
+        'confirmed': get_json_values(df['last_available_confirmed'].iloc[start:]),
+        'deaths': get_json_values(df['last_available_deaths'].iloc[start:]),
+        'new_confirmed': get_json_values(df['new_confirmed'].iloc[start:]),
+        'new_deaths': get_json_values(df['new_deaths'].iloc[start:]),
+        'cases_mavg': get_json_values(df['cases_moving_average'].iloc[start:]),
+        'deaths_mavg': get_json_values(df['deaths_moving_average'].iloc[start:]),
+        'week_years': years[week_start:].tolist(),
+        'weeks': weeks[week_start:].tolist(),
+        'week_confirmed': week_confirmed[week_start:].tolist(),
+        'week_deaths': week_deaths[week_start:].tolist(),
+        'nbins': int(ew['epidemiological_week'].nunique()),
+    })
+
+def get_series_checksum(dates, df, rows, calendar):
+    """Returns a checksum of the first rows of a place, which tells whether the series a browser holds is still current"""
+    # The weekly positions count from the first week of the calendar
+    checksum = zlib.crc32(np.int64(calendar['codes'][0]).tobytes())
+    checksum = zlib.crc32(np.asarray(dates[:rows]).tobytes(), checksum)
+    for col in ['last_available_confirmed', 'last_available_deaths', 'new_confirmed', 'new_deaths']:
+        checksum = zlib.crc32(df[col].to_numpy()[:rows].astype('int64').tobytes(), checksum)
+    return(checksum)
+
+def get_held_series(since, key):
+    """Returns the (rows, checksum) of the series of a place the browser holds, or None"""
+    held = (since or {}).get(key)
+    try:
+        return((int(held['rows']), int(held['checksum'])))
+    except (KeyError, TypeError, ValueError):
+        return(None)
+
+def get_place_key(state, city):
+    """Returns the key of the place of the dashboard, its IBGE code or br for the national data"""
+    place = city if city is not None else state
+    return('br' if place is None else str(int(place)))
+
+def get_json_values(values):
+    """Returns a column as a list of JSON values, floats rounded and NaN as null"""
+    values = np.asarray(values)
+    if(values.dtype.kind == 'f'):
+        return([None if v != v else v for v in values.astype('float64').round(3).tolist()])
+    return(values.tolist())
+
+def generate_graphs(ibge_code, data, held=None, window=0):
+    df = get_data(ibge_code, data)
+    last = data['df'].iloc[data['last'][int(ibge_code)]]
+    dates = get_date_labels(df['date'])
+    # num = df._get_numeric_data()
+    # num[num < 0] = 0
+
+    childrens = generate_figures(dates, df, df, data['calendar'], str(int(ibge_code)), held, window)
+
     ind_cases = generate_indicator(
-        data='{:,d}'.format(df.loc[df['is_last']==True, 'last_available_confirmed'].item()).replace(',','.'),
-        change='{:,d}'.format(df.loc[df['is_last']==True, 'new_confirmed'].item()).replace(',','.'),
-        date=df.loc[df['is_last']==True, 'date'].item(),
+        data='{:,d}'.format(last['last_available_confirmed']).replace(',','.'),
+        change='{:,d}'.format(last['new_confirmed']).replace(',','.'),
+        date=last['date'],
         type='confirmed'
     )
     childrens.append(ind_cases)
 
     ind_deaths = generate_indicator(
-        data='{:,d}'.format(df.loc[df['is_last']==True, 'last_available_deaths'].item()).replace(',', '.'),
-        change='{:,d}'.format(df.loc[df['is_last']==True, 'new_deaths'].item()).replace(',','.'),
-        date=df.loc[df['is_last']==True, 'date'].item(),
+        data='{:,d}'.format(last['last_available_deaths']).replace(',', '.'),
+        change='{:,d}'.format(last['new_deaths']).replace(',','.'),
+        date=last['date'],
         type='deaths'
     )
     childrens.append(ind_deaths)
 
-    data, change = get_growth_data(df)
-    ind_growth = generate_growth_indicator(data, change)
+    current, previous = get_growth_data(ibge_code, data)
+    ind_growth = generate_growth_indicator(current, previous)
     childrens.append(ind_growth)
 
-    mortality, letality = get_letality_data(df)
+    mortality, letality = get_letality_data(ibge_code, data)
     ind_letality = generate_indicator(
         data='{:,.2f}'.format(mortality).replace('.', ','),
         change='{:,.2f}%'.format(letality).replace('.',','),
-        date=df.loc[df['is_last']==True, 'date'].item(),
+        date=last['date'],
         type='letality'
     )
     childrens.append(ind_letality)
 
     return(childrens)
-    
+
+# Indicators of the last complete week the map is colored by
+MAP_METRICS = [
+    ('Casos por 100 mil habitantes', 'growth_current', 'Blues'),
+    ('Óbitos por 100 mil habitantes', 'deaths_current', 'Reds'),
+]
+
+@timed('generate_map_fig')
+def generate_map_fig(column, data):
+    """Returns a tile map of the states colored by an indicator of the last complete week, one square per state"""
+    label, _, colorscale = next(metric for metric in MAP_METRICS if metric[1] == column)
+    tiles = STATES_GRID.merge(STATES, on='state')
+    values = data['places'][column].reindex(tiles['value'].astype('int64')).to_numpy()
+    z = np.full((STATES_GRID['row'].max() + 1, STATES_GRID['col'].max() + 1), np.nan)
+    z[tiles['row'], tiles['col']] = values
+    text = np.full(z.shape, '', dtype=object)
+    text[tiles['row'], tiles['col']] = [
+        '{}: {}'.format(name, 'sem dados' if value != value else '{:,.2f}'.format(value).replace('.', ','))
+        for name, value in zip(tiles['label'], values)
+    ]
+
+    fig = go.Figure(data=[go.Heatmap(
+        z=z,
+        text=text,
+        colorscale=colorscale,
+        xgap=4,
+        ygap=4,
+        colorbar=dict(title=label, titleside='right', thickness=15),
+        hovertemplate = '%{text}<extra></extra>'
+        )]
+    )
+    # State abbreviations over the tiles, clicks go to the tiles below
+    fig.add_trace(go.Scatter(
+        x=tiles['col'],
+        y=tiles['row'],
+        text=tiles['state'],
+        mode='text',
+        hoverinfo='skip'
+    ))
+    fig.update_layout(
+        margin=dict(l=0, r=0, t=0, b=0),
+        dragmode=False,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False, autorange='reversed', scaleanchor='x'),
+        height=450
+    )
+    return(fig)
+
+def get_map_state(click):
+    """Returns the IBGE code of the state of a click on the map, or None"""
+    for point in (click or {}).get('points', []):
+        tile = STATES_GRID.loc[(STATES_GRID['row'] == point.get('y')) & (STATES_GRID['col'] == point.get('x'))]
+        if(point.get('curveNumber') == 0 and len(tile)):
+            return(int(STATES.loc[STATES['state'] == tile['state'].iloc[0], 'value'].iloc[0]))
+    return(None)
+
+# Places of a comparison, and the columns overlaid in its figures
+COMPARE_LIMIT = 10
+COMPARE_SEARCH_LIMIT = 20
+COMPARE_COLUMNS = ['last_available_confirmed', 'last_available_deaths', 'cases_moving_average', 'deaths_moving_average']
+COMPARE_METRICS = [
+    ('cases', 'last_available_confirmed', 'Casos acumulados'),
+    ('deaths', 'last_available_deaths', 'Óbitos acumulados'),
+    ('cases-day', 'cases_moving_average', 'Casos por dia (média móvel de 14 dias)'),
+    ('deaths-day', 'deaths_moving_average', 'Óbitos por dia (média móvel de 14 dias)'),
+]
+
+def get_compare_options(query, selected, data):
+    """Returns the options of the comparison dropdown, the selected places first, then the states and cities matching a query"""
+    selected = [int(code) for code in selected if int(code) in data['labels']]
+    options = [{'label': data['labels'][code], 'value': code} for code in selected]
+    if(len(selected) >= COMPARE_LIMIT):
+        return(options)
+    key = get_search_key(query or '')
+    for label, value in zip(STATES['label'], STATES['value']):
+        if(get_search_key(label).startswith(key) and int(value) not in selected):
+            options.append({'label': label, 'value': int(value)})
+    if(key):
+        for place in search_cities(key, data, limit=COMPARE_SEARCH_LIMIT):
+            if(place['value'] not in selected):
+                options.append({'label': data['labels'][place['value']], 'value': place['value']})
+    return(options)
+
+@timed('get_compare_data')
+def get_compare_data(codes, data, per_capita=False):
+    """Returns a list of (IBGE code, dataframe) with the rows of several places, read from the dataset at once
+
+    Each place is a contiguous slice of the sorted dataset, so the positions
+    of every place are gathered from the index and each column is read with
+    a single take, whose cost only depends on the number of rows returned.
+    """
+    codes = [int(code) for code in codes if int(code) in data['index']]
+    slices = [data['index'][code] for code in codes]
+    lengths = [s.stop - s.start for s in slices]
+    positions = np.concatenate([np.arange(s.start, s.stop) for s in slices] + [np.array([], dtype='int64')])
+    df = data['df']
+    rows = pd.DataFrame({col: df[col].to_numpy()[positions] for col in ['date'] + COMPARE_COLUMNS})
+    if(per_capita):
+        # Places without a population are left without values
+        population = data['places']['population'].reindex(codes).to_numpy()
+        scale = np.repeat(100000 / population, lengths)
+        for col in COMPARE_COLUMNS:
+            rows[col] = rows[col].to_numpy(dtype='float64') * scale
+    stops = np.cumsum(lengths)
+    return([(code, rows.iloc[stop - length:stop]) for code, length, stop in zip(codes, lengths, stops)])
+
+@timed('generate_compare_fig')
+def generate_compare_fig(places, column, per_capita, data):
+    """Returns a figure with one line per place, the places given as a list of (IBGE code, dataframe)"""
+    fig = go.Figure(data=[go.Scatter(
+        name=data['labels'][code],
+        x=get_date_labels(df['date']),
+        y=df[column],
+        mode='lines',
+        hovertemplate = '%{x}: %{y:.3s}'
+        ) for code, df in places]
+    )
+    fig.update_layout(
+        legend=dict(
+            x=0.01,
+            y=1),
+        margin=dict(l=0, r=0, t=0, b=0),
+        dragmode=False,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)',
+        yaxis=dict(gridcolor='#d6d6d6', title='Por 100 mil habitantes' if per_capita else None),
+        xaxis_tickformat = '%d/%m'
+    )
+    return(fig)
+
+def format_ranking_value(value, metric):
+    """Returns an indicator formatted as the dashboard shows it"""
+    text = '{:,.2f}'.format(value).replace('.', ',')
+    return(text + '%' if metric == 'letality' else text)
+
+def generate_ranking_table(metric, state, data):
+    """Returns a table with the top cities by an indicator, in the country or in a state"""
+    rows = [
+        html.Tr([html.Td('{}º'.format(rank)), html.Td(data['labels'][code]), html.Td(format_ranking_value(value, metric))])
+        for rank, code, value in get_ranking(metric, data, state, RANKING_SIZE)
+    ]
+    header = html.Thead(html.Tr([html.Th('#'), html.Th('Cidade'), html.Th(dict(RANKING_METRICS)[metric])]))
+    return(dbc.Table([header, html.Tbody(rows)], striped=True, hover=True, size='sm'))
+
+def generate_ranking_position(city, metric, data):
+    """Returns the rank of a city in the country and in its state, as a sentence"""
+    if(city is None or int(city) not in data['labels']):
+        return('')
+    positions = []
+    state = data['city_states'][int(city)]
+    for scope, name in [(None, 'no Brasil'), (state, 'em ' + state)]:
+        rank = get_rank(city, metric, data, scope)
+        if(rank is not None):
+            positions.append('{}º de {:,d} {}'.format(rank[0], rank[1], name).replace(',', '.'))
+    if(not positions):
+        return('{}: sem dados'.format(data['labels'][int(city)]))
+    return('{}: {}'.format(data['labels'][int(city)], ', '.join(positions)))
+
+def generate_comparison(codes, per_capita, data):
+    """Returns one graph per compared metric, each with the lines of every place"""
+    places = get_compare_data(codes[:COMPARE_LIMIT], data, per_capita)
+    childrens = []
+    for _, column, _ in COMPARE_METRICS:
+        graph = dcc.Graph(
+            figure = generate_compare_fig(places, column, per_capita, data),
+            config = {'displayModeBar': False}
+        )
+        childrens.append([graph])
+    return(childrens)
+
 NAVBAR = dbc.Navbar(
     [
         html.A(
@@ -426,6 +1446,14 @@ DROPDOWNS = [
     ),
 ]
 
+TIME_WINDOW = [
+    dcc.RadioItems(
+        id="time-window",
+        options=[{'label': ' ' + label, 'value': days} for label, days in TIME_WINDOWS],
+        value=0, labelStyle={'display': 'inline-block', 'marginRight': 15},
+    )
+]
+
 LOCATION_LABEL = [
     html.Center(html.H1(id='location-header'))
 ]
@@ -481,13 +1509,19 @@ INDICATORS = [
     )
 ]
 
+def get_graph_placeholder(name):
+    """Returns the initial children of a graph container, the graph itself when the browser builds the figures"""
+    if(CLIENTSIDE_FIGURES):
+        return([dcc.Graph(id='figure-' + name, config={'displayModeBar': False})])
+    return([])
+
 GRAPH_CASES = [
     dbc.Col(
         [
             dbc.Card(
                 [
                     dbc.CardHeader('Casos acumulados'),
-                    dbc.CardBody([html.Div([], id="graph-cases")])
+                    dbc.CardBody([html.Div(get_graph_placeholder('cases'), id="graph-cases")])
                 ]
             ),
         ], sm=12, lg=6, style={"marginTop": 15}
@@ -496,7 +1530,7 @@ GRAPH_CASES = [
         dbc.Card(
             [
                 dbc.CardHeader('Óbitos acumulados'),
-                dbc.CardBody([html.Div([], id="graph-deaths")])
+                dbc.CardBody([html.Div(get_graph_placeholder('deaths'), id="graph-deaths")])
             ]
         ), sm=12, lg=6, style={"marginTop": 15}
     )
@@ -506,7 +1540,7 @@ CASES_PER_DAY = dbc.Col(
     dbc.Card(
         [
             dbc.CardHeader('Casos por dia de notificação'),
-            dbc.CardBody([html.Div([], id="graph-cases-day")])
+            dbc.CardBody([html.Div(get_graph_placeholder('cases-day'), id="graph-cases-day")])
         ]
     ), sm=12, lg=6, style={"marginTop": 15}
 )
@@ -515,7 +1549,7 @@ DEATHS_PER_DAY = dbc.Col(
     dbc.Card(
         [
             dbc.CardHeader('Óbitos por dia de notificação'),
-            dbc.CardBody([html.Div([], id="graph-deaths-day")])
+            dbc.CardBody([html.Div(get_graph_placeholder('deaths-day'), id="graph-deaths-day")])
         ]
     ), sm=12, lg=6, style={"marginTop": 15}
 )
@@ -524,7 +1558,7 @@ CASES_PER_WEEK = dbc.Col(
     dbc.Card(
         [
             dbc.CardHeader('Casos por semana epidemiológica'),
-            dbc.CardBody([html.Div([], id="graph-cases-week")])
+            dbc.CardBody([html.Div(get_graph_placeholder('cases-week'), id="graph-cases-week")])
         ]
     ), sm=12, lg=6, style={"marginTop": 15}
 )
@@ -533,11 +1567,107 @@ DEATHS_PER_WEEK = dbc.Col(
     dbc.Card(
         [
             dbc.CardHeader('Óbitos por semana epidemiológica'),
-            dbc.CardBody([html.Div([], id="graph-deaths-week")])
+            dbc.CardBody([html.Div(get_graph_placeholder('deaths-week'), id="graph-deaths-week")])
         ]
     ), sm=12, lg=6, style={"marginTop": 15}
 )
 
+MAP = [
+    dbc.Col(
+        dbc.Card(
+            [
+                dbc.CardHeader('Última semana epidemiológica completa'),
+                dbc.CardBody(
+                    [
+                        dcc.RadioItems(
+                            id="map-metric",
+                            options=[{'label': ' ' + label, 'value': column} for label, column, _ in MAP_METRICS],
+                            value='growth_current', labelStyle={'display': 'inline-block', 'marginRight': 15},
+                        ),
+                        dcc.Graph(id="map", config={'displayModeBar': False})
+                    ]
+                )
+            ]
+        ), sm=12, lg=6, style={"marginTop": 15}
+    )
+]
+
+COMPARE = [
+    dbc.Col(
+        [
+            dcc.Dropdown(
+                id="compare-places",
+                options=[],
+                value=[], multi=True, placeholder="Digite o nome dos estados e cidades a comparar",
+            ),
+        ],
+        md=12, lg=5, style={"marginTop": 15}
+    ),
+    dbc.Col(
+        [
+            dcc.Checklist(
+                id="compare-per-capita",
+                options=[{'label': ' Por 100 mil habitantes', 'value': 'per-capita'}],
+                value=[],
+            ),
+        ],
+        md=12, lg=2, style={"marginTop": 22}
+    ),
+    dbc.Col(
+        [
+            dbc.Button("Comparar", id="compare-button", color="info", className="mr-1")
+        ],
+        md=12, lg=1, style={'text-align': 'center', "marginTop": 15}
+    ),
+]
+
+COMPARE_GRAPHS = [
+    dbc.Col(
+        dbc.Card(
+            [
+                dbc.CardHeader(header),
+                dbc.CardBody([html.Div([], id="compare-" + name)])
+            ]
+        ), sm=12, lg=6, style={"marginTop": 15}
+    ) for name, _, header in COMPARE_METRICS
+]
+
+RANKING_SIZE = 20
+
+RANKING = [
+    dbc.Col(
+        [
+            dcc.Dropdown(
+                id="ranking-metric",
+                options=[{'label': label, 'value': metric} for metric, label in RANKING_METRICS],
+                value='growth_current', clearable=False,
+            ),
+        ],
+        md=12, lg=4, style={"marginTop": 15}
+    ),
+    dbc.Col(
+        [
+            dcc.Dropdown(
+                id="ranking-state",
+                options=get_dropdown_states(),
+                value=None, placeholder="Todo o Brasil",
+            ),
+        ],
+        md=12, lg=3, style={"marginTop": 15}
+    ),
+]
+
+RANKING_TABLE = [
+    dbc.Col(
+        dbc.Card(
+            [
+                dbc.CardHeader(html.Div(id="ranking-position")),
+                dbc.CardBody([html.Div([], id="ranking-table")])
+            ]
+        ), sm=12, lg=7, style={"marginTop": 15}
+    )
+]
+
 ABOUT = [
     dbc.Col(
         dbc.Card(
@@ -573,26 +1703,25 @@ BODY = dbc.Container(
             [
                 dbc.Row(LOCATION_LABEL, justify='center', style={"marginTop": 30}),
                 dbc.Row(INDICATORS, justify='center', style={"marginTop": 15}),
+                dbc.Row(TIME_WINDOW, justify='center', style={"marginTop": 15}),
                 dbc.Row(GRAPH_CASES, style={"marginTop": 15}),
                 dbc.Row([CASES_PER_WEEK, DEATHS_PER_WEEK], style={"marginTop": 15}),
                 dbc.Row([CASES_PER_DAY, DEATHS_PER_DAY], style={"marginTop": 15}),
             ]
         ),
+        dbc.Row(html.H2('Mapa dos estados'), justify='center', style={"marginTop": 30, 'marginLeft':15}),
+        dbc.Row(MAP, justify='center'),
+        dbc.Row(html.H2('Comparar locais'), justify='center', style={"marginTop": 30, 'marginLeft':15}),
+        dbc.Row(COMPARE, justify='center'),
+        dbc.Spinner(dbc.Row(COMPARE_GRAPHS, style={"marginTop": 15})),
+        dbc.Row(html.H2('Ranking das cidades'), justify='center', style={"marginTop": 30, 'marginLeft':15}),
+        dbc.Row(RANKING, justify='center'),
+        dbc.Row(RANKING_TABLE, justify='center'),
         dbc.Row(html.H2('Sobre o Brashboard'), justify='center', style={"marginTop": 30, 'marginLeft':15}),
         dbc.Row(ABOUT, justify='center', style={"marginTop": 15, "marginBottom": 30})
     ], fluid=True
 )
 
-# National data is calculated from the sum of the data from all state
-br_date = DF.groupby(['date']).sum()
-br_date = br_date.reset_index()
-br_date = br_date.reindex(index=br_date.index[::-1])
-br_date['cases_moving_average'] = moving_average(br_date['new_confirmed'], MAVG_WINDOW)
-br_date['deaths_moving_average'] = moving_average(br_date['new_deaths'], MAVG_WINDOW)
-br_date = br_date.reindex(index=br_date.index[::-1])
-br_ew = DF.groupby(['epidemiological_week']).sum()
-br_ew = br_ew.reset_index()
-
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.UNITED],
     meta_tags=[
         {
@@ -643,89 +1772,158 @@ app.index_string = '''
 
 server = app.server
 
-app.layout = dbc.Container([NAVBAR, BODY], fluid=True, style={'padding-right':'0px', 'padding-left':'0px'})
-
-# Callback to update city dropdown only when a state is selected
+# Until the dataset is loaded only the readiness check is answered
+@server.before_request
+def check_ready():
+    if(not READY.is_set() and flask.request.path != '/ready'):
+        return(flask.Response('Loading the data, try again', status=503, headers={'Retry-After': '5'}))
+    return(None)
+
+@server.route('/ready')
+def ready():
+    data = DATA
+    status = {
+        'ready': READY.is_set(),
+        'version': data['version'] if data is not None else None,
+        'error': STARTUP['error'],
+        'startup_seconds': dict(STARTUP_PHASES),
+    }
+    return(flask.Response(json.dumps(status), status=200 if status['ready'] else 503, mimetype='application/json'))
+
+# Registered before the other hooks, so the time of cached responses counts
+@server.before_request
+def start_request_timer():
+    if(METRICS):
+        flask.g.request_start = time.perf_counter()
+
+@server.after_request
+def stop_request_timer(response):
+    begin = flask.g.pop('request_start', None)
+    if(begin is not None and flask.request.url_rule is not None):
+        record_time('request ' + flask.request.url_rule.rule, time.perf_counter() - begin)
+    return(response)
+
+# Data of the selected place, and the plotly.py template the browser styles
+# the figures with, sent once with the layout
+STORES = [
+    dcc.Store(id='place-data'),
+    dcc.Store(id='place-series', storage_type='local'),
+    dcc.Store(id='place-since'),
+    dcc.Store(id='place-view'),
+    dcc.Store(id='figure-template', data=go.Figure().layout.template.to_plotly_json())
+] if CLIENTSIDE_FIGURES else []
+
+app.layout = dbc.Container([NAVBAR, BODY] + STORES, fluid=True, style={'padding-right':'0px', 'padding-left':'0px'})
+
+# Callback to update city dropdown when a state is selected and as the user
+# types, so only a few of the cities of a state are sent at once
 @app.callback(
     [Output('city', 'options'),
     Output('city', 'disabled'),
     Output('city', 'value')],
-    [Input('state', 'value')])
-def update_dropdowns(state):
-    if(state is not None):
-        return(get_dropdown_cities(state), False, None)
-    else:
+    [Input('state', 'value'),
+    Input('city', 'search_value')],
+    [State('city', 'value')])
+def update_dropdowns(state, search, city):
+    if(state is None):
         return([], True, None)
+    if('state.value' in [t['prop_id'] for t in dash.callback_context.triggered]):
+        return(get_city_options(None, state, None, DATA), False, None)
+    return(get_city_options(search, state, city, DATA), dash.no_update, dash.no_update)
 
-# Callback to update the graphs only after the submit button is pressed
-@app.callback(
-    [Output('graph-cases', 'children'),
-    Output('graph-deaths', 'children'),
-    Output('graph-cases-day', 'children'),
-    Output('graph-deaths-day', 'children'),
-    Output('graph-cases-week', 'children'),
-    Output('graph-deaths-week', 'children'),
+FIGURES = ['cases', 'deaths', 'cases-day', 'deaths-day', 'cases-week', 'deaths-week']
+
+if(CLIENTSIDE_FIGURES):
+    FIGURES_OUTPUTS = [Output('place-data', 'data')]
+else:
+    FIGURES_OUTPUTS = [Output('graph-' + name, 'children') for name in FIGURES]
+
+GRAPHS_OUTPUTS = FIGURES_OUTPUTS + [
     Output('indicator-cases', 'children'),
     Output('indicator-deaths', 'children'),
     Output('indicator-growth', 'children'),
     Output('indicator-letality', 'children'),
-    Output('location-header', 'children')],
+    Output('location-header', 'children')
+]
+
+# The browser sends the rows it holds of each place it keeps, so only new
+# days are sent back, and cuts the time window itself
+GRAPHS_INPUTS = [Input('submit-button', 'n_clicks')]
+GRAPHS_STATES = [State('state', 'value'), State('city', 'value')]
+if(CLIENTSIDE_FIGURES):
+    GRAPHS_STATES.append(State('place-since', 'data'))
+else:
+    GRAPHS_INPUTS.append(Input('time-window', 'value'))
+
+# Renders run in a bounded pool, so however many requests the server
+# threads accept, only a few build figures at once. Past the queue limit
+# requests get a 503 right away instead of piling up behind the others.
+RENDER_POOL = {'pid': None, 'executor': None}
+RENDER_STATS = {'pending': 0, 'rejected': 0}
+RENDER_LOCK = threading.Lock()
+
+def get_render_pool():
+    """Returns the render pool of this process, pools do not survive a fork"""
+    with RENDER_LOCK:
+        if(RENDER_POOL['pid'] != os.getpid()):
+            RENDER_POOL['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=RENDER_THREADS)
+            RENDER_POOL['pid'] = os.getpid()
+    return(RENDER_POOL['executor'])
+
+def run_render(func, *args):
+    """Returns the result of a render run in the render pool, aborts with a 503 if the pool is saturated"""
+    if(RENDER_THREADS <= 0):
+        return(func(*args))
+    with RENDER_LOCK:
+        if(RENDER_STATS['pending'] >= RENDER_THREADS + RENDER_QUEUE):
+            RENDER_STATS['rejected'] += 1
+            saturated = True
+        else:
+            RENDER_STATS['pending'] += 1
+            saturated = False
+    if(saturated):
+        flask.abort(flask.Response('Server busy, try again', status=503, headers={'Retry-After': '1'}))
+    try:
+        return(get_render_pool().submit(func, *args).result())
+    finally:
+        with RENDER_LOCK:
+            RENDER_STATS['pending'] -= 1
 
-    [Input('submit-button', 'n_clicks')],
+# Callback to update the graphs only after the submit button is pressed
+@app.callback(
+    GRAPHS_OUTPUTS,
+
+    GRAPHS_INPUTS,
 
-    [State('state', 'value'),
-    State('city', 'value')])
-def update_graphs(click, state, city):
+    GRAPHS_STATES)
+@timed('update_graphs')
+def update_graphs(click, *args):
+    if(CLIENTSIDE_FIGURES):
+        state, city, since = args
+        return(run_render(render_graphs, state, city, get_held_series(since, get_place_key(state, city))))
+    window, state, city = args
+    return(run_render(render_graphs, state, city, None, int(window or 0)))
+
+def render_graphs(state, city, held=None, window=0):
+    data = DATA
     if(city is not None):
-        childrens = generate_graphs(city)
-        location = get_ibge_label(city, type='city')
+        childrens = generate_graphs(city, data, held, window)
+        location = get_ibge_label(city, type='city', data=data)
         childrens.append(location)
 
     else:
         if(state is not None):
-            childrens = generate_graphs(state)
-            location = get_ibge_label(state, type='state')
+            childrens = generate_graphs(state, data, held, window)
+            location = get_ibge_label(state, type='state', data=data)
             childrens.append(location)
         else:
             # National data
-            childrens = []
             location = 'Brasil'
+            br_date = data['br_date']
+            br_ew = data['br_ew']
+            dates = get_date_labels(br_date['date'])
             
-            cases  = dcc.Graph(
-                figure = generate_scatter_fig(x=br_date['date'], y=br_date['last_available_confirmed'], type='last_available_confirmed'),
-                config = {'displayModeBar': False}
-            )
-            childrens.append(cases)
-
-            deaths = dcc.Graph(
-                figure = generate_scatter_fig(x=br_date['date'], y=br_date['last_available_deaths'], type='last_available_deaths'),
-                config = {'displayModeBar': False}
-            )
-            childrens.append(deaths)
-
-            cases_day = dcc.Graph(
-                figure = generate_bar_fig(x=br_date['date'], y=br_date['new_confirmed'], mavg=br_date['cases_moving_average'], type='new_confirmed'),
-                config = {'displayModeBar': False}
-            )
-            childrens.append(cases_day)
-
-            deaths_day = dcc.Graph(
-                figure = generate_bar_fig(x=br_date['date'], y=br_date['new_deaths'], mavg=br_date['deaths_moving_average'], type='new_deaths'),
-                config = {'displayModeBar': False}
-            )
-            childrens.append(deaths_day)
-
-            cases_week = dcc.Graph(
-                figure = generate_histogram_fig(x=br_ew['epidemiological_week'], y=br_ew['new_confirmed'], type='new_confirmed'),
-                config = {'displayModeBar': False}
-            )
-            childrens.append(cases_week)
-
-            deaths_week = dcc.Graph(
-                figure = generate_histogram_fig(x=br_ew['epidemiological_week'], y=br_ew['new_deaths'], type='new_deaths'),
-                config = {'displayModeBar': False}
-            )
-            childrens.append(deaths_week)
+            childrens = generate_figures(dates, br_date, br_ew, data['calendar'], 'br', held, window)
 
             ind_cases = generate_indicator(
                 data='{:,d}'.format(br_date.iloc[-1]['last_available_confirmed'].item()).replace(',','.'),
@@ -762,6 +1960,743 @@ def update_graphs(click, state, city):
 
     return(childrens)
 
+# Callback to update the map when another indicator is picked
+@app.callback(
+    Output('map', 'figure'),
+    [Input('map-metric', 'value')])
+def update_map(column):
+    return(generate_map_fig(column, DATA))
+
+# Callback to pick a state in the dropdown by clicking it on the map
+@app.callback(
+    Output('state', 'value'),
+    [Input('map', 'clickData')])
+def select_map_state(click):
+    state = get_map_state(click)
+    if(state is None):
+        raise PreventUpdate
+    return(state)
+
+# Callback to update the ranking, and the rank of the selected city in it
+@app.callback(
+    [Output('ranking-table', 'children'),
+    Output('ranking-position', 'children')],
+    [Input('ranking-metric', 'value'),
+    Input('ranking-state', 'value'),
+    Input('city', 'value')])
+def update_ranking(metric, state, city):
+    data = DATA
+    state = None if state is None else STATES.loc[STATES['value'] == int(state), 'state'].item()
+    return(generate_ranking_table(metric, state, data), generate_ranking_position(city, metric, data))
+
+# Callback to update the options of the comparison as the user types, the
+# selected places are kept so the dropdown still shows them
+@app.callback(
+    Output('compare-places', 'options'),
+    [Input('compare-places', 'search_value')],
+    [State('compare-places', 'value')])
+def update_compare_options(search, selected):
+    return(get_compare_options(search, selected or [], DATA))
+
+# Callback to update the comparison only after its button is pressed
+@app.callback(
+    [Output('compare-' + name, 'children') for name, _, _ in COMPARE_METRICS],
+    [Input('compare-button', 'n_clicks')],
+    [State('compare-places', 'value'),
+    State('compare-per-capita', 'value')])
+@timed('update_comparison')
+def update_comparison(click, codes, options):
+    if(not codes):
+        raise PreventUpdate
+    return(run_render(generate_comparison, codes, 'per-capita' in (options or []), DATA))
+
+# The place data is merged into the series the browser keeps in its local
+# storage, and the figures are built from the result by assets/figures.js
+if(CLIENTSIDE_FIGURES):
+    app.clientside_callback(
+        ClientsideFunction(namespace='figures', function_name='merge'),
+        [Output('place-series', 'data'), Output('place-view', 'data')],
+        [Input('place-data', 'data')],
+        [State('place-series', 'data')]
+    )
+    app.clientside_callback(
+        ClientsideFunction(namespace='figures', function_name='since'),
+        Output('place-since', 'data'),
+        [Input('place-series', 'data')]
+    )
+    app.clientside_callback(
+        ClientsideFunction(namespace='figures', function_name='build'),
+        [Output('figure-' + name, 'figure') for name in FIGURES],
+        [Input('place-view', 'data'), Input('time-window', 'value')],
+        [State('figure-template', 'data')]
+    )
+
+# The update_graphs responses only change with the dataset, so the serialized
+# payload of each place is kept in a LRU cache keyed by the dataset version and
+# served before Dash runs the callback. Browsers that loaded a place on the
+# same day hold the same rows, so the new days they get are cached too.
+# The JSON API has a cache of its own, so its clients never evict the graphs.
+UPDATE_COMPONENT_PATH = app.config.routes_pathname_prefix + '_dash-update-component'
+GRAPHS_OUTPUT_ID = '..{}..'.format('...'.join('{}.{}'.format(o.component_id, o.component_property) for o in GRAPHS_OUTPUTS))
+RESPONSE_CACHES = {
+    'graphs': {'entries': OrderedDict(), 'size': RESPONSE_CACHE_SIZE, 'hits': 0, 'misses': 0},
+    'api': {'entries': OrderedDict(), 'size': API_CACHE_SIZE, 'hits': 0, 'misses': 0},
+}
+RESPONSE_CACHE_LOCK = threading.Lock()
+
+def get_cached_response(name, key):
+    """Returns the payload of a key in a cache, or None on a miss"""
+    cache = RESPONSE_CACHES[name]
+    with RESPONSE_CACHE_LOCK:
+        payload = cache['entries'].get(key)
+        if(payload is None):
+            cache['misses'] += 1
+        else:
+            cache['entries'].move_to_end(key)
+            cache['hits'] += 1
+    return(payload)
+
+def cache_response(name, key, payload):
+    """Stores a payload in a cache, evicting the least recently used ones above its size cap"""
+    cache = RESPONSE_CACHES[name]
+    if(cache['size'] <= 0):
+        return
+    with RESPONSE_CACHE_LOCK:
+        cache['entries'][key] = payload
+        cache['entries'].move_to_end(key)
+        while(len(cache['entries']) > cache['size']):
+            cache['entries'].popitem(last=False)
+
+def clear_response_cache():
+    """Drops every cached payload, called when the dataset changes"""
+    with RESPONSE_CACHE_LOCK:
+        for cache in RESPONSE_CACHES.values():
+            cache['entries'].clear()
+
+def get_graphs_request(state, city, since=None, window=0):
+    """Returns the body of the update_graphs request Dash sends for a place"""
+    values = {'submit-button': 1, 'time-window': window, 'state': state, 'city': city, 'place-since': since}
+    return({
+        'output': GRAPHS_OUTPUT_ID,
+        'outputs': [{'id': o.component_id, 'property': o.component_property} for o in GRAPHS_OUTPUTS],
+        'inputs': [{'id': i.component_id, 'property': i.component_property, 'value': values[i.component_id]} for i in GRAPHS_INPUTS],
+        'state': [{'id': s.component_id, 'property': s.component_property, 'value': values[s.component_id]} for s in GRAPHS_STATES],
+        'changedPropIds': ['submit-button.n_clicks']
+    })
+
+@server.before_request
+def serve_cached_graphs():
+    if(RESPONSE_CACHE_SIZE <= 0 or flask.request.path != UPDATE_COMPONENT_PATH):
+        return(None)
+    body = flask.request.get_json(silent=True)
+    if(not body or body.get('output') != GRAPHS_OUTPUT_ID):
+        return(None)
+    values = {s['id']: s.get('value') for s in body.get('inputs', []) + body.get('state', [])}
+    place = get_place_key(values.get('state'), values.get('city'))
+    key = (place, DATA['version'], get_held_series(values.get('place-since'), place), values.get('time-window') or 0)
+    payload = get_cached_response('graphs', key)
+    if(payload is not None):
+        return(flask.Response(payload, mimetype='application/json'))
+    flask.g.graphs_key = key
+    return(None)
+
+@server.after_request
+def store_graphs_response(response):
+    key = flask.g.pop('graphs_key', None)
+    if(key is not None and response.status_code == 200):
+        cache_response('graphs', key, response.get_data())
+    return(response)
+
+def warm_up(n):
+    """Renders the national view and the n most populous places into the response cache"""
+    client = server.test_client()
+    client.post(UPDATE_COMPONENT_PATH, json=get_graphs_request(None, None))
+    for code in DATA['places']['population'].nlargest(n).index:
+        # States have two-digit IBGE codes, cities seven
+        state, city = (int(code), None) if code < 100 else (None, int(code))
+        client.post(UPDATE_COMPONENT_PATH, json=get_graphs_request(state, city))
+
+
+# JSON API serving the same in-memory dataset to other tools as compact
+# columnar payloads. Payloads are kept in their own LRU cache, keyed by the
+# dataset version, which also tags them for conditional requests.
+API_PREFIX = '/api/v1'
+API_MAX_AGE = int(os.environ.get('BRASHBOARD_API_MAX_AGE', '300'))
+API_ENCODINGS = {
+    'br': lambda payload: brotli.compress(payload, quality=9),
+    'gzip': lambda payload: gzip.compress(payload, compresslevel=6),
+}
+SERIES_COLUMNS = [
+    'epidemiological_week', 'last_available_confirmed', 'last_available_deaths',
+    'new_confirmed', 'new_deaths', 'cases_moving_average', 'deaths_moving_average'
+]
+
+def get_json_number(value):
+    """Returns a float rounded for JSON, NaN as null"""
+    value = float(value)
+    return(None if value != value else round(value, 3))
+
+def get_api_place(ibge_code, data):
+    """Returns the description of a place, None stands for the national data"""
+    if(ibge_code is None):
+        return({'ibge_code': None, 'label': 'Brasil', 'place_type': 'country'})
+    # States have two-digit IBGE codes, cities seven
+    type = 'state' if ibge_code < 100 else 'city'
+    return({'ibge_code': ibge_code, 'label': get_ibge_label(ibge_code, type, data), 'place_type': type})
+
+def get_api_series(ibge_code, data):
+    """Returns the daily series of a place, one list per column"""
+    df = data['br_date'] if ibge_code is None else get_data(ibge_code, data)
+    columns = {'date': get_date_labels(df['date']).tolist()}
+    for col in SERIES_COLUMNS:
+        columns[col] = get_json_values(df[col])
+    return({'place': get_api_place(ibge_code, data), 'version': data['version'], 'columns': columns})
+
+def get_api_indicators(ibge_code, data):
+    """Returns the indicators of a place, the numbers shown above its graphs"""
+    if(ibge_code is None):
+        last = data['br_date'].iloc[-1]
+        br_ew = data['br_ew']
+        population = POP_BR
+        growth_current = br_ew.iloc[-2]['new_confirmed'] / POP_BR * 100000
+        growth_last = br_ew.iloc[-3]['new_confirmed'] / POP_BR * 100000
+        mortality = last['last_available_deaths'] / POP_BR * 100000
+        letality = last['last_available_deaths'] / last['last_available_confirmed'] * 100
+    else:
+        last = data['df'].iloc[data['last'].get(ibge_code, data['index'][ibge_code].stop - 1)]
+        place = data['places'].loc[ibge_code]
+        population = place['population']
+        growth_current, growth_last = place['growth_current'], place['growth_last']
+        mortality, letality = place['mortality'], place['letality']
+    return({
+        'place': get_api_place(ibge_code, data),
+        'version': data['version'],
+        'date': str(pd.Timestamp(last['date']).date()),
+        'confirmed': int(last['last_available_confirmed']),
+        'deaths': int(last['last_available_deaths']),
+        'new_confirmed': int(last['new_confirmed']),
+        'new_deaths': int(last['new_deaths']),
+        'population': get_json_number(population),
+        'growth_current': get_json_number(growth_current),
+        'growth_last': get_json_number(growth_last),
+        'mortality': get_json_number(mortality),
+        'letality': get_json_number(letality),
+    })
+
+def get_api_response(build, ibge_code):
+    """Returns the response of an API payload, compressed and tagged with the dataset version"""
+    data = DATA
+    if(ibge_code is not None and ibge_code not in data['index']):
+        flask.abort(404)
+    tag = hashlib.sha1(str(data['version']).encode()).hexdigest()[:16]
+    encoding = next((e for e in API_ENCODINGS if e in flask.request.accept_encodings), None)
+    if(flask.request.if_none_match.contains_weak(tag)):
+        response = flask.Response(status=304)
+    else:
+        key = (build.__name__, ibge_code, data['version'], encoding)
+        payload = get_cached_response('api', key)
+        if(payload is None):
+            payload = json.dumps(build(ibge_code, data), separators=(',', ':')).encode()
+            if(encoding is not None):
+                payload = API_ENCODINGS[encoding](payload)
+            cache_response('api', key, payload)
+        response = flask.Response(payload, mimetype='application/json')
+        if(encoding is not None):
+            # Also keeps Flask-Compress from compressing it again
+            response.headers['Content-Encoding'] = encoding
+    # Weak, the compressed and plain payloads of a version are equivalent
+    response.set_etag(tag, weak=True)
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(API_MAX_AGE)
+    response.headers['Vary'] = 'Accept-Encoding'
+    return(response)
+
+@server.route(API_PREFIX + '/series/br', defaults={'ibge_code': None})
+@server.route(API_PREFIX + '/series/<int:ibge_code>')
+def api_series(ibge_code):
+    return(get_api_response(get_api_series, ibge_code))
+
+@server.route(API_PREFIX + '/indicators/br', defaults={'ibge_code': None})
+@server.route(API_PREFIX + '/indicators/<int:ibge_code>')
+def api_indicators(ibge_code):
+    return(get_api_response(get_api_indicators, ibge_code))
+
+CITY_SEARCH_LIMIT = 50
+
+# Typeahead over every city, so clients don't need the options of a whole state
+@server.route(API_PREFIX + '/cities')
+def api_cities():
+    args = flask.request.args
+    state = args.get('state')
+    limit = min(args.get('limit', 10, type=int), CITY_SEARCH_LIMIT)
+    data = DATA
+    cities = search_cities(args.get('q', ''), data, state=state.upper() if state else None, limit=limit)
+    response = flask.Response(json.dumps(cities, separators=(',', ':')), mimetype='application/json')
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(API_MAX_AGE)
+    return(response)
+
+RANKING_LIMIT = 100
+
+def get_ranking_args(metric):
+    """Returns the ranking of a request and its state abbreviation, aborts with a 404 if there is none"""
+    state = flask.request.args.get('state')
+    state = state.upper() if state else None
+    if(metric not in dict(RANKING_METRICS) or (state is not None and state not in set(STATES['state']))):
+        flask.abort(404)
+    return(state)
+
+def get_json_response(payload):
+    """Returns a JSON response of a small payload built on each request"""
+    response = flask.Response(json.dumps(payload, separators=(',', ':')), mimetype='application/json')
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(API_MAX_AGE)
+    return(response)
+
+# Top cities by an indicator, optionally in a state, read from the rankings
+# sorted at load
+@server.route(API_PREFIX + '/rankings/<metric>')
+def api_ranking(metric):
+    state = get_ranking_args(metric)
+    args = flask.request.args
+    limit = min(max(args.get('limit', RANKING_SIZE, type=int), 0), RANKING_LIMIT)
+    offset = max(args.get('offset', 0, type=int), 0)
+    data = DATA
+    ranking = data['rankings'][metric].get(state)
+    return(get_json_response({
+        'metric': metric,
+        'state': state,
+        'version': data['version'],
+        'total': 0 if ranking is None else len(ranking['codes']),
+        'places': [
+            {'rank': rank, 'ibge_code': code, 'label': data['labels'][code], 'value': get_json_number(value)}
+            for rank, code, value in get_ranking(metric, data, state, limit, offset)
+        ],
+    }))
+
+# Rank of a city, in the country and in its state
+@server.route(API_PREFIX + '/rankings/<metric>/<int:ibge_code>')
+def api_rank(metric, ibge_code):
+    get_ranking_args(metric)
+    data = DATA
+    rank = get_rank(ibge_code, metric, data)
+    if(rank is None):
+        flask.abort(404)
+    state = data['city_states'][ibge_code]
+    state_rank = get_rank(ibge_code, metric, data, state)
+    return(get_json_response({
+        'metric': metric,
+        'version': data['version'],
+        'place': get_api_place(ibge_code, data),
+        'value': get_json_number(data['places'].loc[ibge_code, metric]),
+        'rank': rank[0],
+        'total': rank[1],
+        'state': state,
+        'state_rank': state_rank[0],
+        'state_total': state_rank[1],
+    }))
+
+# Bulk export of the rows of some places, streamed in chunks so even a whole
+# state is never copied at once. The rows of each place are found with the
+# index, and the date range with a binary search within them.
+EXPORT_COLUMNS = list(SCHEMA) + ['cases_moving_average', 'deaths_moving_average']
+EXPORT_TYPES = dict(SCHEMA, cases_moving_average='float32', deaths_moving_average='float32')
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+class ExportBuffer(io.RawIOBase):
+    """Writable stream keeping what is written until it is taken, so file writers can feed a generator"""
+
+    def __init__(self):
+        self.blocks = []
+        self.position = 0
+
+    def writable(self):
+        return(True)
+
+    def write(self, block):
+        self.blocks.append(bytes(block))
+        self.position += len(block)
+        return(len(block))
+
+    def tell(self):
+        return(self.position)
+
+    def take(self):
+        data = b''.join(self.blocks)
+        self.blocks = []
+        return(data)
+
+def get_export_codes(args, data):
+    """Returns the IBGE codes of an export request, its codes and the state and cities of its state, aborts if there are none"""
+    codes = []
+    try:
+        codes.extend(int(code) for code in args.get('codes', '').split(',') if code.strip())
+    except ValueError:
+        flask.abort(400)
+    state = args.get('state')
+    if(state):
+        state = STATES.loc[STATES['state'] == state.upper(), 'value']
+        if(state.empty):
+            flask.abort(404)
+        codes.append(int(state.item()))
+        codes.extend(option['value'] for option in data['options'].get(int(state.item()), []))
+    if(not codes):
+        flask.abort(400)
+    if(any(code not in data['index'] for code in codes)):
+        flask.abort(404)
+    # Each place once, in the order asked
+    return(list(OrderedDict.fromkeys(codes)))
+
+def get_export_date(value):
+    """Returns a YYYY-MM-DD date of an export request as a datetime64, aborts if it is not one"""
+    if(not value):
+        return(None)
+    try:
+        return(np.datetime64(value, 'D').astype('datetime64[ns]'))
+    except ValueError:
+        flask.abort(400)
+
+def get_export_slices(codes, data, start=None, end=None):
+    """Returns the slices of the rows of places between two dates, both included"""
+    dates = data['df']['date'].to_numpy()
+    slices = []
+    for code in codes:
+        rows = data['index'][code]
+        first = rows.start if start is None else rows.start + int(np.searchsorted(dates[rows], start))
+        last = rows.stop if end is None else rows.start + int(np.searchsorted(dates[rows], end, side='right'))
+        if(first < last):
+            slices.append(slice(first, last))
+    return(slices)
+
+def get_export_chunk(df, positions, columns):
+    """Returns the rows at some positions of the dataset with some columns, labels as strings and missing populations as nulls"""
+    chunk = pd.DataFrame({col: np.asarray(df[col].array.take(positions)) for col in columns})
+    if('estimated_population' in chunk):
+        population = chunk['estimated_population'].to_numpy()
+        chunk['estimated_population'] = pd.arrays.IntegerArray(population, population == 0)
+    return(chunk)
+
+def get_export_chunks(slices, data, columns):
+    """Yields the rows of slices of the dataset in dataframes of about EXPORT_CHUNK_ROWS rows, at least one even if empty"""
+    df = data['df']
+    pending, size, sent = [], 0, False
+    for rows in slices:
+        for begin in range(rows.start, rows.stop, EXPORT_CHUNK_ROWS):
+            stop = min(begin + EXPORT_CHUNK_ROWS, rows.stop)
+            pending.append(np.arange(begin, stop))
+            size += stop - begin
+            if(size >= EXPORT_CHUNK_ROWS):
+                yield(get_export_chunk(df, np.concatenate(pending), columns))
+                pending, size, sent = [], 0, True
+    if(pending or not sent):
+        yield(get_export_chunk(df, np.concatenate(pending + [np.array([], dtype='int64')]), columns))
+
+def write_csv(chunks, columns):
+    """Yields the rows of chunks as CSV, with a header"""
+    yield((','.join(columns) + '\n').encode())
+    for chunk in chunks:
+        data = chunk.to_csv(index=False, header=False, date_format='%Y-%m-%d').encode()
+        if(data):
+            yield(data)
+
+def write_gzip(stream):
+    """Yields a stream of bytes compressed with gzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for block in stream:
+        data = compressor.compress(block)
+        if(data):
+            yield(data)
+    yield(compressor.flush())
+
+def get_arrow_schema(columns):
+    """Returns the Arrow schema of an export with some columns, labels as strings"""
+    import pyarrow
+    types = {
+        'category': pyarrow.string(),
+        'int32': pyarrow.int32(),
+        'datetime64[ns]': pyarrow.timestamp('ns'),
+        'bool': pyarrow.bool_(),
+        'float32': pyarrow.float32(),
+    }
+    return(pyarrow.schema([(col, types[EXPORT_TYPES[col]]) for col in columns]))
+
+def write_arrow(chunks, columns, format):
+    """Yields the rows of chunks as a Parquet file, one row group per chunk, or as an Arrow IPC stream"""
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    # The schema is fixed up front, a chunk whose labels are all null would
+    # otherwise infer a null column and fail to write in the middle of the file
+    schema = get_arrow_schema(columns)
+    sink = ExportBuffer()
+    if(format == 'parquet'):
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+    for chunk in chunks:
+        writer.write_table(pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        yield(sink.take())
+    writer.close()
+    yield(sink.take())
+
+@server.route(API_PREFIX + '/export')
+def api_export():
+    args = flask.request.args
+    format = args.get('format', 'csv')
+    # A column asked twice is sent once, in the place it was first asked
+    columns = list(dict.fromkeys(args.get('columns', '').split(','))) if args.get('columns') else EXPORT_COLUMNS
+    if(format not in EXPORT_FORMATS or any(col not in EXPORT_COLUMNS for col in columns)):
+        flask.abort(400)
+    if(format in ('parquet', 'arrow') and importlib.util.find_spec('pyarrow') is None):
+        # Optional, see requirements-export.txt
+        flask.abort(501)
+    data = DATA
+    codes = get_export_codes(args, data)
+    slices = get_export_slices(codes, data, get_export_date(args.get('start')), get_export_date(args.get('end')))
+    # The generators hold this version of the dataset, a refresh does not cut an export short
+    chunks = get_export_chunks(slices, data, columns)
+    if(format == 'csv'):
+        stream = write_csv(chunks, columns)
+    elif(format == 'csv.gz'):
+        stream = write_gzip(write_csv(chunks, columns))
+    else:
+        stream = write_arrow(chunks, columns, format)
+    mimetype, extension = EXPORT_FORMATS[format]
+    response = flask.Response(stream, mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=brashboard.{}'.format(extension)
+    return(response)
+
+def fetch_update(url, version):
+    """Returns a stream with the data source and its version if it changed since a version, else (None, version)"""
+    path = get_source_path(url)
+    if(path is not None):
+        current = get_data_version(url)
+        return((None, version) if current == version else (open(path, 'rb'), current))
+    # Conditional GET, the version is either an ETag or a Last-Modified date.
+    # A version made up at load time means nothing to the source.
+    if(version.startswith('loaded-')):
+        headers = {}
+    elif(version.startswith(('"', 'W/'))):
+        headers = {'If-None-Match': version}
+    else:
+        headers = {'If-Modified-Since': version}
+    r = requests.get(url, headers=headers, stream=True, timeout=60)
+    if(r.status_code == 304):
+        r.close()
+        return(None, version)
+    r.raise_for_status()
+    return(r.raw, r.headers.get('ETag') or r.headers.get('Last-Modified'))
+
+def get_last_dates(data):
+    """Returns the date of the last row of each place, as a Series indexed by IBGE code"""
+    dates = data['df']['date'].to_numpy()
+    return(pd.Series(dates[[rows.stop - 1 for rows in data['index'].values()]], index=list(data['index'])))
+
+def merge_data(df, new):
+    """Returns the dataset with the rows of new days appended"""
+    old = df.drop(columns=['cases_moving_average', 'deaths_moving_average'])
+    # The last row of a place that got new days is no longer its last one
+    updated = np.isin(
+        old['city_ibge_code'].to_numpy(),
+        new['city_ibge_code'].to_numpy()
+    )
+    old['is_last'] = old['is_last'].to_numpy() & ~updated
+    return(sort_data(pd.concat([old, new], ignore_index=True)))
+
+# Only one process refreshes the data, the one holding a lock on a file of
+# the cache directory. It writes each new version to the cache and publishes
+# its path, and the other workers read it from there (memory-mapped with
+# BRASHBOARD_SHARED_DATA) instead of each downloading and parsing it again.
+# If the refreshing process dies its lock is released, and the next worker
+# that checks takes over.
+REFRESHER = {'pid': None, 'lock': None}
+
+def is_refresher():
+    """Returns True if this process is the one refreshing the data, taking the role if nobody has it"""
+    if(REFRESHER['lock'] is None):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        REFRESHER['lock'] = open(os.path.join(CACHE_DIR, 'refresh.lock'), 'w')
+    try:
+        fcntl.flock(REFRESHER['lock'], fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return(False)
+    return(True)
+
+def publish_data(version, path):
+    """Records the version and cache directory of the data the other workers should load"""
+    published = os.path.join(CACHE_DIR, 'published.json')
+    tmp = '{}.tmp{}'.format(published, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'version': version, 'path': path, 'time': time.time()}, f)
+    os.replace(tmp, published)
+
+def get_published_data():
+    """Returns the version and cache directory of the data published by the refreshing process, or None"""
+    try:
+        with open(os.path.join(CACHE_DIR, 'published.json')) as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return(None)
+
+def fetch_data(url, current):
+    """Returns the dataset and version of a new version of the data source, or (None, version) if there is none"""
+    source, version = fetch_update(url, current['version'])
+    if(source is None):
+        return(None, version)
+    path = find_cache(version)
+    if(path is not None):
+        # A previous refreshing process already parsed this version
+        source.close()
+        df, version = read_cache(path)
+        publish_data(version, path)
+        return(df, version)
+    if(version is None):
+        version = get_load_version()
+    if(INCREMENTAL_REFRESH):
+        df = add_derived_columns(merge_data(current['df'], download_data(source=source, since=get_last_dates(current))))
+        # Not the upstream file, so it is cached under its own key, which a
+        # restart looking for the upstream version never loads
+        path = write_cache(df, version, key='merged-' + version)
+    else:
+        df = add_derived_columns(download_data(source=source))
+        path = write_cache(df, version)
+    publish_data(version, path)
+    if(SHARED_DATA):
+        # Drop the private copy in favour of the shared memory map
+        df, version = read_cache(path)
+    return(df, version)
+
+@timed('refresh_data')
+def refresh_data(url=URL_DATA):
+    """Loads a new version of the data source if there is one and swaps it in, returns True if it did"""
+    global DATA
+    current = DATA
+    if(is_refresher()):
+        df, version = fetch_data(url, current)
+    else:
+        published = get_published_data()
+        # A file left by an earlier run, or a version this process loaded itself, is skipped
+        if(published is None or published['time'] <= current['loaded'] or published['version'] == current['version']):
+            return(False)
+        df, version = read_cache(published['path'])
+    if(df is None):
+        return(False)
+    # Everything is built before the swap, requests keep using the old
+    # dataset until this single assignment
+    DATA = build_dataset(df, version)
+    clear_response_cache()
+    if(WARMUP_PLACES > 0):
+        warm_up(WARMUP_PLACES)
+    return(True)
+
+def run_refresher(interval):
+    while(True):
+        time.sleep(interval)
+        try:
+            refresh_data()
+        except Exception as e:
+            # Keep serving the current data and try again later
+            server.logger.warning('Data refresh failed: %s', e)
+
+def start_refresher():
+    """Starts the background data refresher of this process, if enabled and not running yet"""
+    if(REFRESH_INTERVAL <= 0 or REFRESHER['pid'] == os.getpid()):
+        return
+    # A lock file inherited through a fork belongs to the parent
+    REFRESHER['pid'] = os.getpid()
+    REFRESHER['lock'] = None
+    threading.Thread(target=run_refresher, args=(REFRESH_INTERVAL,), daemon=True).start()
+
+
+DATASET_BYTES = {'version': None, 'bytes': 0}
+
+def get_dataset_bytes(data):
+    """Returns the memory used by the dataset, measured once per version"""
+    if(DATASET_BYTES['version'] != data['version']):
+        DATASET_BYTES['bytes'] = int(get_memory_report(data['df']).loc['total', 'bytes'])
+        DATASET_BYTES['version'] = data['version']
+    return(DATASET_BYTES['bytes'])
+
+def format_metric(name, type, help, samples):
+    """Returns the lines of a metric in the Prometheus text format, samples are (suffix, labels, value)"""
+    lines = ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, type)]
+    for suffix, labels, value in samples:
+        labels = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+        lines.append('{}{}{} {}'.format(name, suffix, '{' + labels + '}' if labels else '', value))
+    return(lines)
+
+def get_metrics():
+    """Returns the metrics of this process in the Prometheus text format"""
+    data = DATA
+    with STAGE_LOCK:
+        stages = {stage: dict(times, buckets=list(times['buckets'])) for stage, times in STAGE_TIMES.items()}
+    samples = []
+    for stage, times in sorted(stages.items()):
+        # Prometheus buckets are cumulative
+        for bound, count in zip(METRICS_BUCKETS, np.cumsum(times['buckets'])):
+            samples.append(('_bucket', {'stage': stage, 'le': bound}, count))
+        samples.append(('_bucket', {'stage': stage, 'le': '+Inf'}, times['count']))
+        samples.append(('_sum', {'stage': stage}, times['sum']))
+        samples.append(('_count', {'stage': stage}, times['count']))
+    lines = format_metric('brashboard_stage_seconds', 'histogram', 'Duration of the stages of requests, data loads and refreshes.', samples)
+    with RESPONSE_CACHE_LOCK:
+        caches = [(name, cache['hits'], cache['misses'], len(cache['entries'])) for name, cache in RESPONSE_CACHES.items()]
+    # One series per cache, graphs for the dashboard and api for the JSON API
+    lines += format_metric('brashboard_response_cache_hits_total', 'counter', 'Responses served from a response cache.', [('', {'cache': name}, hits) for name, hits, misses, entries in caches])
+    lines += format_metric('brashboard_response_cache_misses_total', 'counter', 'Responses not found in a response cache.', [('', {'cache': name}, misses) for name, hits, misses, entries in caches])
+    lines += format_metric('brashboard_response_cache_entries', 'gauge', 'Responses in a response cache.', [('', {'cache': name}, entries) for name, hits, misses, entries in caches])
+    lines += format_metric('brashboard_render_rejected_total', 'counter', 'Renders rejected with a 503 because the render pool was saturated.', [('', {}, RENDER_STATS['rejected'])])
+    lines += format_metric('brashboard_render_pending', 'gauge', 'Renders running or waiting in the render pool.', [('', {}, RENDER_STATS['pending'])])
+    lines += format_metric('brashboard_dataset_rows', 'gauge', 'Rows of the dataset.', [('', {}, len(data['df']))])
+    lines += format_metric('brashboard_dataset_bytes', 'gauge', 'Memory used by the dataset.', [('', {}, get_dataset_bytes(data))])
+    lines += format_metric('brashboard_dataset_info', 'gauge', 'Version of the dataset being served.', [('', {'version': data['version']}, 1)])
+    return('\n'.join(lines) + '\n')
+
+@server.route('/metrics')
+def metrics():
+    if(not METRICS):
+        flask.abort(404)
+    return(flask.Response(get_metrics(), mimetype='text/plain; version=0.0.4'))
+
+# The app is built first and the dataset loaded last, in the background with
+# BRASHBOARD_BACKGROUND_LOAD=1, so a worker answers /ready (and 503s) at once
+def start_app():
+    """Loads the dataset, then warms the response cache and starts the refresher"""
+    global DATA
+    try:
+        df, version = load_data()
+        mark_startup('load_data')
+        DATA = build_dataset(df, version)
+        mark_startup('build_dataset')
+    except Exception as e:
+        STARTUP['error'] = str(e)
+        if(BACKGROUND_LOAD):
+            # Nobody joins this thread, and a worker without data would answer
+            # 503 forever, so the process exits and gunicorn starts a new one
+            traceback.print_exc()
+            sys.stderr.flush()
+            os._exit(1)
+        raise
+    READY.set()
+    if(WARMUP_PLACES > 0):
+        warm_up(WARMUP_PLACES)
+        mark_startup('warm_up')
+    # With a preloaded app the workers start it after the fork, see gunicorn.conf.py
+    if(not SHARED_DATA):
+        start_refresher()
+    if(PROFILE_STARTUP):
+        report = ', '.join('{} {:.2f}s'.format(phase, seconds) for phase, seconds in STARTUP_PHASES.items())
+        print('Startup: {} (total {:.2f}s)'.format(report, sum(STARTUP_PHASES.values())), file=sys.stderr)
+
+mark_startup('app')
+if(BACKGROUND_LOAD):
+    threading.Thread(target=start_app, daemon=True).start()
+else:
+    start_app()
+
 application = app.server
 if __name__ == '__main__':
     #app.run_server(debug=True)
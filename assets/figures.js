@@ -0,0 +1,173 @@
+// Builds the six graphs of a place in the browser from the columns sent by
+// update_graphs when BRASHBOARD_CLIENTSIDE_FIGURES is set. Mirrors
+// generate_scatter_fig, generate_bar_fig and generate_histogram_fig.
+//
+// The series of the last places shown are kept in the local storage, and
+// update_graphs only sends the days after the ones held, see
+// get_figures_data.
+(function() {
+    var BLUE = '#008cff';
+    var RED = '#ff0000';
+    var HOVER = '%{x}: %{y:.3s}<extra></extra>';
+    // Places kept in the local storage, the least recently shown dropped first
+    var HELD_PLACES = 20;
+    var DAILY = ['dates', 'confirmed', 'deaths', 'new_confirmed', 'new_deaths', 'cases_mavg', 'deaths_mavg'];
+    var WEEKLY = ['week_years', 'weeks', 'week_confirmed', 'week_deaths'];
+
+    function layout(template, extra) {
+        var base = {
+            template: template,
+            margin: {l: 0, r: 0, t: 0, b: 0},
+            dragmode: false,
+            paper_bgcolor: 'rgba(0,0,0,0)',
+            plot_bgcolor: 'rgba(0,0,0,0)',
+            yaxis: {gridcolor: '#d6d6d6'}
+        };
+        return Object.assign(base, extra);
+    }
+
+    function scatter(x, y, color, fillcolor, template) {
+        return {
+            data: [{
+                type: 'scatter',
+                x: x,
+                y: y,
+                mode: 'lines+markers',
+                line: {color: color},
+                fill: 'tozeroy',
+                fillcolor: fillcolor,
+                hovertemplate: HOVER
+            }],
+            layout: layout(template, {xaxis: {tickformat: '%d/%m'}})
+        };
+    }
+
+    function bar(x, y, mavg, color, traceColor, template) {
+        return {
+            data: [{
+                type: 'bar',
+                showlegend: false,
+                name: 'Novos casos',
+                x: x,
+                y: y,
+                marker: {color: color},
+                hovertemplate: HOVER
+            }, {
+                type: 'scatter',
+                name: 'Média móvel (14 dias)',
+                x: x,
+                y: mavg,
+                marker: {color: traceColor},
+                hovertemplate: HOVER
+            }],
+            layout: layout(template, {legend: {x: 0.01, y: 1}, xaxis: {tickformat: '%d/%m'}})
+        };
+    }
+
+    function histogram(data, y, color, template) {
+        return {
+            data: [{
+                type: 'histogram',
+                histfunc: 'sum',
+                x: [data.week_years, data.weeks],
+                y: y,
+                marker: {color: color},
+                nbinsx: data.nbins,
+                autobinx: false,
+                hovertemplate: HOVER
+            }],
+            layout: layout(template, {xaxis: {dtick: 2}, bargap: 0.2})
+        };
+    }
+
+    // Returns the series of a place with the values sent replacing the held
+    // ones from the start positions on
+    function update(held, data) {
+        var place = Object.assign({}, data, {start: 0, week_start: 0});
+        DAILY.forEach(function(name) {
+            place[name] = held[name].slice(0, data.start).concat(data[name]);
+        });
+        WEEKLY.forEach(function(name) {
+            place[name] = held[name].slice(0, data.week_start).concat(data[name]);
+        });
+        return place;
+    }
+
+    // Returns the series cut to its last days, and to the weeks they fall
+    // in, as generate_figures does
+    function cut(data, days) {
+        if(!days || !data.dates.length) {
+            return data;
+        }
+        var DAY = 86400000;
+        var last = new Date(data.dates[data.dates.length - 1]);
+        var first = new Date(last.getTime() - (days - 1) * DAY);
+        var start = 0;
+        while(start < data.dates.length && new Date(data.dates[start]) < first) {
+            start++;
+        }
+        if(start === 0) {
+            return data;
+        }
+        // Weeks run from Sunday, count the ones between the first day and the last week
+        var from = new Date(data.dates[start]);
+        var weeks = Math.floor(((last - from) / DAY + from.getUTCDay()) / 7) + 1;
+        var week_start = Math.max(data.weeks.length - weeks, 0);
+        var view = Object.assign({}, data, {nbins: weeks});
+        DAILY.forEach(function(name) {
+            view[name] = data[name].slice(start);
+        });
+        WEEKLY.forEach(function(name) {
+            view[name] = data[name].slice(week_start);
+        });
+        return view;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        figures: {
+            merge: function(data, series) {
+                if(!data) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                series = series || {order: [], places: {}};
+                var places = Object.assign({}, series.places);
+                var order = series.order.filter(function(key) { return key !== data.key; });
+                var held = places[data.key];
+                if(data.start > 0 && !held) {
+                    // Dropped by another tab meanwhile, the next request gets the whole series
+                    return [{order: order, places: places}, window.dash_clientside.no_update];
+                }
+                var place = data.start > 0 ? update(held, data) : data;
+                places[data.key] = place;
+                order.push(data.key);
+                while(order.length > HELD_PLACES) {
+                    delete places[order.shift()];
+                }
+                return [{order: order, places: places}, place];
+            },
+            since: function(series) {
+                var since = {};
+                if(series) {
+                    series.order.forEach(function(key) {
+                        since[key] = {rows: series.places[key].rows, checksum: series.places[key].checksum};
+                    });
+                }
+                return since;
+            },
+            build: function(data, days, template) {
+                if(!data) {
+                    throw window.dash_clientside.PreventUpdate;
+                }
+                data = cut(data, days);
+                return [
+                    scatter(data.dates, data.confirmed, BLUE, 'rgba(0,140,255,0.3)', template),
+                    scatter(data.dates, data.deaths, RED, 'rgba(255,0,0,0.3)', template),
+                    bar(data.dates, data.new_confirmed, data.cases_mavg, BLUE, RED, template),
+                    bar(data.dates, data.new_deaths, data.deaths_mavg, RED, '#000', template),
+                    histogram(data, data.week_confirmed, BLUE, template),
+                    histogram(data, data.week_deaths, RED, template)
+                ];
+            }
+        }
+    });
+})();
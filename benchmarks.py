@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for the dashboard data path.
+
+The dataset is loaded the same way the app does it, so BRASHBOARD_DATA_URL
+can point to a local copy of caso_full.csv.gz to run them offline:
+
+    python benchmarks.py            # every benchmark
+    python benchmarks.py index      # only the listed ones
+"""
+
+import sys
+import time
+import timeit
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+import application
+
+REPEAT = 5
+NUMBER = 50
+
+def time_call(func):
+    """Returns the best time of a call in milliseconds"""
+    return(min(timeit.repeat(func, repeat=REPEAT, number=NUMBER)) / NUMBER * 1000)
+
+def get_sample_places():
+    """Returns a list of (name, IBGE code) with the largest and smallest cities and a state"""
+    data = application.DATA
+    last = data['df'].iloc[sorted(data['last'].values())]
+    cities = last.loc[last['place_type'] == 'city'].sort_values(by='estimated_population')
+    states = last.loc[last['place_type'] == 'state']
+    state = 35 if 35 in data['index'] else int(states['city_ibge_code'].iloc[0])
+    return([
+        ('large city', int(cities['city_ibge_code'].iloc[-1])),
+        ('small city', int(cities['city_ibge_code'].iloc[0])),
+        ('state', state)
+    ])
+
+def benchmark_index():
+    """Compares the full-table scan with the IBGE code index when fetching a place and its last row"""
+    data = application.DATA
+    df = data['df']
+
+    def scan(code):
+        rows = df.loc[df['city_ibge_code'] == code]
+        rows.loc[rows['is_last'] == True]
+
+    def index(code):
+        df.iloc[data['index'][code]]
+        df.iloc[data['last'][code]]
+
+    print('{:<12}{:>10}{:>12}{:>12}{:>10}'.format('place', 'rows', 'scan (ms)', 'index (ms)', 'speedup'))
+    for name, code in get_sample_places():
+        before = time_call(lambda: scan(code))
+        after = time_call(lambda: index(code))
+        rows = len(df.iloc[data['index'][code]])
+        print('{:<12}{:>10}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(name, rows, before, after, before / after))
+
+def loop_moving_average(data, window):
+    """The original per-row moving average, kept as the reference implementation"""
+    mov_avg = []
+    for i in range(len(data)):
+        if(i + window > len(data)):
+            mov_avg.append(np.mean(data[i:len(data)]))
+        else:
+            mov_avg.append(np.mean(data[i:i+window]))
+    return(mov_avg)
+
+def benchmark_moving_average():
+    """Checks the vectorized moving average against the loop implementation and times both"""
+    window = application.MAVG_WINDOW
+    rng = np.random.RandomState(0)
+    series = {
+        'short': pd.Series(rng.poisson(50, window // 2), dtype='Int32'),
+        'daily': pd.Series(rng.poisson(50, 600), dtype='Int32'),
+        'with nulls': pd.Series(rng.poisson(50, 600), dtype='Int32').mask(rng.rand(600) < 0.1),
+        'float': pd.Series(rng.normal(0, 1e6, 600)),
+    }
+    print('{:<12}{:>8}{:>12}{:>12}{:>12}'.format('series', 'rows', 'max diff', 'loop (ms)', 'vector (ms)'))
+    for name, data in series.items():
+        expected = np.array(loop_moving_average(data, window), dtype='float64')
+        result = application.moving_average(data, window)
+        assert np.allclose(result, expected, equal_nan=True), name
+        diff = np.nanmax(np.abs(result - expected))
+        before = time_call(lambda: loop_moving_average(data, window))
+        after = time_call(lambda: application.moving_average(data, window))
+        print('{:<12}{:>8}{:>12.2e}{:>12.3f}{:>12.3f}'.format(name, len(data), diff, before, after))
+
+    frame = pd.DataFrame({name: series['daily'] for name in ['new_confirmed', 'new_deaths']})
+    batched = application.moving_average(frame, window)
+    for i, name in enumerate(frame.columns):
+        assert np.allclose(batched[:, i], loop_moving_average(frame[name], window)), name
+    print('batched call over {} columns matches'.format(len(frame.columns)))
+
+def benchmark_memory():
+    """Prints the memory used by each column of the dataset"""
+    print(application.get_memory_report(application.DATA['df']).to_string())
+
+def benchmark_lookup():
+    """Compares the dataframe filters with the precomputed dictionaries for the dropdown options and labels"""
+    data = application.DATA
+    cities = application.build_cities(data['df'])
+    states = application.STATES
+
+    def scan(state, city):
+        state_abr = states.loc[states['value'] == state].state.item()
+        state_cities = cities.loc[cities['state'] == state_abr]
+        state_cities.drop(labels=['place_type', 'state'], axis=1).to_dict('records')
+        label = cities.loc[cities['value'] == city].label.item()
+        '{} ({})'.format(label, cities.loc[cities['value'] == city].state.item())
+
+    def lookup(state, city):
+        application.get_dropdown_cities(state, data)
+        application.get_ibge_label(city, 'city', data)
+
+    print('{:<12}{:>10}{:>12}{:>12}{:>10}'.format('state', 'cities', 'scan (ms)', 'dict (ms)', 'speedup'))
+    for state, options in sorted(data['options'].items(), key=lambda item: -len(item[1]))[:3]:
+        city = options[0]['value']
+        before = time_call(lambda: scan(state, city))
+        after = time_call(lambda: lookup(state, city))
+        print('{:<12}{:>10}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(state, len(options), before, after, before / after))
+    after = time_call(lambda: application.search_cities('sao', data))
+    print('search of a prefix: {:.3f} ms'.format(after))
+
+def merge_weekly_data(x, y):
+    """The original weekly histogram data, a 2020/2021 calendar built and merged on every call"""
+    x1 = x.astype(str).str.slice(4, 6)
+    current_ew = int(x1.iloc[-1])
+    ews = pd.concat([pd.Series([str(x).zfill(2) for x in range(1, 54)]), pd.Series([str(x).zfill(2) for x in range(1, current_ew+1)])])
+    ys = pd.concat([pd.Series([2020]*53), pd.Series([2021]*current_ew)])
+    df_ew = pd.DataFrame({"ew":ews, "year":ys})
+    df_ew['ew_int'] = (df_ew['year'].astype(str) + df_ew['ew'].astype(str)).astype(int)
+    return(pd.merge(df_ew, pd.DataFrame({'ew_int':x, 'y':y}), how='left', on='ew_int'))
+
+def benchmark_weekly():
+    """Checks the weekly sums of the calendar against the merge, within its 2020/2021 range, and times both"""
+    data = application.DATA
+    print('{:<12}{:>8}{:>12}{:>14}{:>10}'.format('place', 'weeks', 'merge (ms)', 'bincount (ms)', 'speedup'))
+    for name, code in get_sample_places():
+        df = application.get_data(code, data)
+        x, y = df['epidemiological_week'], df['new_confirmed']
+        years, weeks, sums = application.get_weekly_data(x, y, data['calendar'])
+        if(x.max() < 202200):
+            merged = merge_weekly_data(x, y).groupby(['year', 'ew'], sort=False)['y'].sum()
+            assert np.array_equal(merged.to_numpy()[:len(sums)], sums), name
+        before = time_call(lambda: merge_weekly_data(x, y))
+        after = time_call(lambda: application.get_weekly_data(x, y, data['calendar']))
+        print('{:<12}{:>8}{:>12.3f}{:>14.3f}{:>9.1f}x'.format(name, len(sums), before, after, before / after))
+
+def benchmark_compare():
+    """Compares one filter per place with the batched take of get_compare_data when fetching the most populous places"""
+    data = application.DATA
+    df = data['df']
+    population = data['places']['population'].dropna().sort_values()
+    columns = ['date'] + application.COMPARE_COLUMNS
+
+    def scan(codes):
+        return([(code, df.loc[df['city_ibge_code'] == code, columns]) for code in codes])
+
+    print('{:<8}{:>10}{:>12}{:>14}{:>10}'.format('places', 'rows', 'scan (ms)', 'batched (ms)', 'speedup'))
+    for n in [2, 5, application.COMPARE_LIMIT]:
+        codes = [int(code) for code in population.index[-n:]]
+        batched = application.get_compare_data(codes, data)
+        for (code, expected), (_, result) in zip(scan(codes), batched):
+            assert np.array_equal(expected[columns].to_numpy(), result[columns].to_numpy()), code
+        before = time_call(lambda: scan(codes))
+        after = time_call(lambda: application.get_compare_data(codes, data))
+        rows = sum(len(rows) for _, rows in batched)
+        print('{:<8}{:>10}{:>12.3f}{:>14.3f}{:>9.1f}x'.format(n, rows, before, after, before / after))
+
+def benchmark_ranking():
+    """Compares sorting the indicators of the cities on each request with the rankings sorted at load"""
+    data = application.DATA
+    places = data['places']
+    cities = places.loc[[code for code in places.index if code in data['city_states']]]
+    states = cities.index.map(data['city_states'])
+
+    def scan(metric, state):
+        values = cities[metric] if state is None else cities.loc[states == state, metric]
+        return(values.loc[np.isfinite(values)].sort_values(ascending=False, kind='mergesort').head(20))
+
+    print('{:<16}{:>8}{:>12}{:>14}{:>10}'.format('metric', 'state', 'sort (ms)', 'ranking (ms)', 'speedup'))
+    for metric, _ in application.RANKING_METRICS:
+        for state in [None, 'SP']:
+            expected = scan(metric, state)
+            result = application.get_ranking(metric, data, state, 20)
+            assert [code for _, code, _ in result] == expected.index.tolist(), (metric, state)
+            before = time_call(lambda: scan(metric, state))
+            after = time_call(lambda: application.get_ranking(metric, data, state, 20))
+            print('{:<16}{:>8}{:>12.3f}{:>14.3f}{:>9.1f}x'.format(metric, state or 'BR', before, after, before / after))
+
+def concat_ingest(url):
+    """The original ingest, small chunks collected in a list and concatenated at the end"""
+    dtype = {col: 'Int32' if t == 'int32' else t for col, t in application.SCHEMA.items() if t in ('int32', 'category')}
+    chunks = []
+    with application.open_source(url) as source:
+        for chunk in pd.read_csv(source, compression='gzip', chunksize=5000, dtype=dtype, usecols=list(application.SCHEMA)):
+            chunks.append(chunk)
+    return(pd.concat(chunks))
+
+def get_rss():
+    """Returns the resident memory of this process in bytes (Linux only)"""
+    with open('/proc/self/statm') as f:
+        return(int(f.read().split()[1]) * resource.getpagesize())
+
+def run_ingest(url, rows, results):
+    start = get_rss()
+    begin = time.perf_counter()
+    df = concat_ingest(url) if rows is None else ingest_with_chunk_rows(url, rows)
+    elapsed = time.perf_counter() - begin
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results.put((elapsed, peak - start, df.memory_usage(deep=True).sum()))
+
+def benchmark_ingest():
+    """Times the ingest of the configured source and compares its peak memory with the size of the result"""
+    url = application.URL_DATA
+    variants = [('concat, 5000 rows', None)] + [('pipeline, {} rows'.format(rows), rows) for rows in [5000, 10000, 50000]]
+    print('{:<24}{:>10}{:>14}{:>14}'.format('ingest', 'time (s)', 'peak (MB)', 'result (MB)'))
+    # Each run gets a fresh interpreter, the peak RSS of a process never goes
+    # down and a forked one would reuse the heap this one already holds
+    context = multiprocessing.get_context('spawn')
+    for name, rows in variants:
+        results = context.Queue()
+        process = context.Process(target=run_ingest, args=(url, rows, results))
+        process.start()
+        elapsed, peak, size = results.get()
+        process.join()
+        print('{:<24}{:>10.2f}{:>14.1f}{:>14.1f}'.format(name, elapsed, peak / 2**20, size / 2**20))
+
+def ingest_with_chunk_rows(url, rows):
+    application.INGEST_CHUNK_ROWS = rows
+    return(application.download_data(url))
+
+BENCHMARKS = {
+    'index': benchmark_index,
+    'moving_average': benchmark_moving_average,
+    'memory': benchmark_memory,
+    'lookup': benchmark_lookup,
+    'weekly': benchmark_weekly,
+    'compare': benchmark_compare,
+    'ranking': benchmark_ranking,
+    'ingest': benchmark_ingest,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    print('{} rows'.format(len(application.DATA['df'])))
+    for name in names:
+        print('\n# {}'.format(name))
+        BENCHMARKS[name]()
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import os
+
+# With BRASHBOARD_SHARED_DATA=1 the app is imported once in the master, which
+# downloads or reads the dataset cache and memory-maps it. Workers
+# are forked from the master and share those pages instead of each loading
+# its own copy, so adding workers barely adds memory.
+preload_app = os.environ.get('BRASHBOARD_SHARED_DATA') == '1'
+
+# Threads per worker. Above 1 gunicorn uses gthread workers, where slow
+# clients and cache hits no longer hold a whole worker. Figure renders are
+# still bounded by BRASHBOARD_RENDER_THREADS, see the README for tuning.
+threads = int(os.environ.get('BRASHBOARD_THREADS', '1'))
+
+def post_fork(server, worker):
+    # Threads do not survive the fork, so a preloaded app starts the data
+    # refresher in each worker. Only the one holding the refresh lock
+    # downloads new versions, the others load them from the cache.
+    if(preload_app):
+        import application
+        application.start_refresher()
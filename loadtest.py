@@ -0,0 +1,294 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Load test of the dashboard callbacks.
+
+Starts the app under gunicorn against a dataset from synthetic_data.py,
+replays the requests the browser sends to /_dash-update-component for
+update_dropdowns and update_graphs, with a Zipf-distributed mix of national,
+state and city views, and reports latency percentiles, throughput, response
+sizes and worker memory. Results are saved as JSON to compare runs:
+
+    python loadtest.py --cities 1000 --days 400 --output before.json
+    python loadtest.py --cities 1000 --days 400 --output after.json --compare before.json
+
+Extra settings of the app are passed through the BRASHBOARD_* environment
+variables, e.g. BRASHBOARD_RESPONSE_CACHE_SIZE=0 to measure cold renders.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import requests
+import synthetic_data
+
+PERCENTILES = [50, 95, 99]
+
+def get_free_port():
+    """Returns a TCP port nobody listens on"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return(s.getsockname()[1])
+
+def start_server(data, cache, port, workers, threads):
+    """Starts the app under gunicorn and returns its process once it answers"""
+    env = dict(os.environ, BRASHBOARD_DATA_URL=data, BRASHBOARD_CACHE_DIR=cache, BRASHBOARD_THREADS=str(threads))
+    command = [
+        sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+        '--bind', '127.0.0.1:{}'.format(port), '--workers', str(workers), '--timeout', '600',
+        'application:application'
+    ]
+    server = subprocess.Popen(command, env=env, cwd=synthetic_data.ROOT)
+    deadline = time.time() + 600
+    while(time.time() < deadline):
+        if(server.poll() is not None):
+            raise RuntimeError('The server exited with code {}'.format(server.returncode))
+        try:
+            if(requests.get('http://127.0.0.1:{}/ready'.format(port), timeout=5).ok):
+                return(server)
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError('The server did not start in time')
+
+def get_rss(pid):
+    """Returns the resident memory of a process in bytes, 0 if it is gone (Linux only)"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if(line.startswith('VmRSS:')):
+                    return(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    return(0)
+
+def get_children(pid):
+    """Returns the process ids of the children of a process (Linux only)"""
+    children = []
+    for task in os.listdir('/proc/{}/task'.format(pid)):
+        with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+            children.extend(int(child) for child in f.read().split())
+    return(children)
+
+def get_callbacks(url):
+    """Returns the dependencies of the update_dropdowns and update_graphs callbacks"""
+    callbacks = {}
+    for dependency in requests.get(url + '/_dash-dependencies').json():
+        if(dependency.get('clientside_function')):
+            continue
+        inputs = [i['id'] + '.' + i['property'] for i in dependency['inputs']]
+        if(inputs[:1] == ['state.value']):
+            callbacks['dropdowns'] = dependency
+        elif('submit-button.n_clicks' in inputs):
+            # The time window is an input too when the server builds the figures
+            callbacks['graphs'] = dependency
+    return(callbacks)
+
+def get_request(dependency, values):
+    """Returns the body Dash sends to run a callback, with the values of its inputs and states"""
+    outputs = []
+    for output in dependency['output'].strip('.').split('...'):
+        component, prop = output.rsplit('.', 1)
+        outputs.append({'id': component, 'property': prop})
+    return({
+        'output': dependency['output'],
+        'outputs': outputs if len(outputs) > 1 else outputs[0],
+        'inputs': [dict(i, value=values.get(i['id'])) for i in dependency['inputs']],
+        'state': [dict(s, value=values.get(s['id'])) for s in dependency['state']],
+        # Only the first input, the dropdown or the button, is the one a user changes
+        'changedPropIds': [dependency['inputs'][0]['id'] + '.' + dependency['inputs'][0]['property']]
+    })
+
+def get_places(data):
+    """Returns the places of the dashboard, as the values of the state and city dropdowns
+
+    The city dropdown only sends the cities matching what the user types, so
+    the cities are read from the dataset, the state being the first two
+    digits of their IBGE code.
+    """
+    df = pd.read_csv(data, usecols=['city_ibge_code', 'place_type']).drop_duplicates()
+    codes = df.loc[df['place_type'] == 'city', 'city_ibge_code'].dropna().astype('int64')
+    codes = np.sort(codes[codes != 0].to_numpy())
+    places = [(None, None)]
+    for _, state, _ in synthetic_data.get_states():
+        places.append((state, None))
+        places.extend((state, int(code)) for code in codes[codes // 100000 == state])
+    return(places)
+
+def get_mix(places, n, exponent, dropdown_share, seed):
+    """Returns n requests drawn with Zipf-distributed popularity
+
+    The national view is the most popular, then the states and cities in a
+    random order, so a few places get most of the requests.
+    """
+    rng = random.Random(seed)
+    ranked = places[:1] + rng.sample(places[1:], len(places) - 1)
+    weights = [1 / (rank ** exponent) for rank in range(1, len(ranked) + 1)]
+    states = [place for place in ranked if place[0] is not None and place[1] is None]
+    state_weights = [1 / (rank ** exponent) for rank in range(1, len(states) + 1)]
+    mix = []
+    for _ in range(n):
+        if(rng.random() < dropdown_share):
+            state, _ = rng.choices(states, state_weights)[0]
+            mix.append(('dropdowns', {'state': state}))
+        else:
+            state, city = rng.choices(ranked, weights)[0]
+            mix.append(('graphs', {'submit-button': 1, 'time-window': 0, 'state': state, 'city': city}))
+    return(mix)
+
+def run_requests(url, callbacks, mix, concurrency):
+    """Sends the requests from concurrent clients and returns (kind, status, seconds, bytes, wire bytes) of each one"""
+    local = threading.local()
+
+    def send(item):
+        kind, values = item
+        if(not hasattr(local, 'session')):
+            local.session = requests.Session()
+        body = get_request(callbacks[kind], values)
+        begin = time.perf_counter()
+        r = local.session.post(url + '/_dash-update-component', json=body)
+        elapsed = time.perf_counter() - begin
+        wire = int(r.headers.get('Content-Length', len(r.content)))
+        return((kind, r.status_code, elapsed, len(r.content), wire))
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        return(list(executor.map(send, mix)))
+
+def summarize(results, elapsed):
+    """Returns the latency percentiles, throughput and sizes of a list of request results"""
+    latencies = np.array([r[2] for r in results]) * 1000
+    statuses = {}
+    for r in results:
+        statuses[str(r[1])] = statuses.get(str(r[1]), 0) + 1
+    summary = {
+        'requests': len(results),
+        'errors': sum(1 for r in results if r[1] != 200),
+        'status': statuses,
+        'throughput_rps': len(results) / elapsed,
+        'latency_ms': {'mean': float(latencies.mean()), 'max': float(latencies.max())},
+        'bytes_mean': float(np.mean([r[3] for r in results])),
+        'wire_bytes_mean': float(np.mean([r[4] for r in results])),
+    }
+    for p in PERCENTILES:
+        summary['latency_ms']['p{}'.format(p)] = float(np.percentile(latencies, p))
+    return(summary)
+
+def print_summary(name, summary, previous=None):
+    """Prints a summary line, with the change from a previous run if given"""
+    latency = summary['latency_ms']
+    line = '{:<10}{:>8}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}{:>12.0f}{:>12.0f}'.format(
+        name, summary['requests'], summary['errors'], summary['throughput_rps'],
+        latency['p50'], latency['p95'], latency['p99'], summary['bytes_mean'], summary['wire_bytes_mean'])
+    print(line)
+    if(previous is not None):
+        before = previous['latency_ms']
+        print('{:<10}{:>16}{:>+10.0%}{:>+10.0%}{:>+10.0%}{:>+10.0%}{:>+12.0%}{:>+12.0%}'.format(
+            '  change', '', summary['throughput_rps'] / previous['throughput_rps'] - 1,
+            latency['p50'] / before['p50'] - 1, latency['p95'] / before['p95'] - 1, latency['p99'] / before['p99'] - 1,
+            summary['bytes_mean'] / previous['bytes_mean'] - 1, summary['wire_bytes_mean'] / previous['wire_bytes_mean'] - 1))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test of the dashboard callbacks')
+    parser.add_argument('--data', help='dataset to serve, a synthetic one is generated if not given')
+    parser.add_argument('--cities', type=int, default=540, help='cities of the synthetic dataset')
+    parser.add_argument('--days', type=int, default=300, help='days of the synthetic dataset')
+    parser.add_argument('--requests', type=int, default=2000, help='requests to send')
+    parser.add_argument('--warmup', type=int, default=100, help='requests sent before measuring')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the popularity of the places')
+    parser.add_argument('--dropdowns', type=float, default=0.2, help='share of update_dropdowns requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to save the results to, as JSON')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    return(parser.parse_args())
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        data = args.data
+        if(data is None):
+            data = os.path.join(tmp, 'caso_full.csv.gz')
+            print('Writing a dataset with {} cities and {} days'.format(args.cities, args.days))
+            synthetic_data.write_dataset(data, args.cities, args.days, args.seed)
+        port = get_free_port()
+        url = 'http://127.0.0.1:{}'.format(port)
+        begin = time.perf_counter()
+        server = start_server(os.path.abspath(data), os.path.join(tmp, 'cache'), port, args.workers, args.threads)
+        boot = time.perf_counter() - begin
+        try:
+            callbacks = get_callbacks(url)
+            places = get_places(data)
+            mix = get_mix(places, args.warmup + args.requests, args.zipf, args.dropdowns, args.seed)
+            run_requests(url, callbacks, mix[:args.warmup], args.concurrency)
+
+            # Peak memory of the workers, sampled while the requests run
+            peak = {}
+            done = threading.Event()
+
+            def sample():
+                while(not done.wait(0.2)):
+                    for pid in get_children(server.pid):
+                        peak[pid] = max(peak.get(pid, 0), get_rss(pid))
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+            begin = time.perf_counter()
+            results = run_requests(url, callbacks, mix[args.warmup:], args.concurrency)
+            elapsed = time.perf_counter() - begin
+            done.set()
+            sampler.join()
+            workers = [get_rss(pid) for pid in get_children(server.pid)]
+            master = get_rss(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'config': dict(vars(args), places=len(places), env={k: v for k, v in os.environ.items() if k.startswith('BRASHBOARD_')}),
+        'boot_seconds': boot,
+        'duration_seconds': elapsed,
+        'all': summarize(results, elapsed),
+        'rss_bytes': {
+            'master': master,
+            'workers': workers,
+            'workers_peak': sorted(peak.values()),
+        },
+    }
+    for kind in ['graphs', 'dropdowns']:
+        subset = [r for r in results if r[0] == kind]
+        if(subset):
+            report[kind] = summarize(subset, elapsed)
+
+    previous = None
+    if(args.compare):
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print('{} places, {} requests from {} clients in {:.1f}s, booted in {:.1f}s'.format(
+        len(places), len(results), args.concurrency, elapsed, boot))
+    print('{:<10}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}{:>12}{:>12}'.format(
+        'requests', 'count', 'errors', 'req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'bytes', 'wire bytes'))
+    for kind in ['all', 'graphs', 'dropdowns']:
+        if(kind in report):
+            print_summary(kind, report[kind], previous.get(kind) if previous else None)
+    print('worker RSS (MB): {}, peak {}, master {:.1f}'.format(
+        ', '.join('{:.1f}'.format(rss / 2**20) for rss in workers),
+        ', '.join('{:.1f}'.format(rss / 2**20) for rss in report['rss_bytes']['workers_peak']),
+        master / 2**20))
+    if(args.output):
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Generator of synthetic caso_full.csv.gz datasets, for offline and scale tests.
+
+The file has the columns and formats of the brasil.io dataset, so the app
+boots from it through BRASHBOARD_DATA_URL:
+
+    python synthetic_data.py caso_full.csv.gz                          # about today's size
+    python synthetic_data.py --cities 11140 --days 1200 big.csv.gz     # 2x the cities, 2x the days
+    BRASHBOARD_DATA_URL=caso_full.csv.gz python application.py
+
+Cities are spread over the states as the real ones are, with log-normal
+populations. Cases follow a few epidemic waves shifted per state and city,
+with weekly reporting cycles, overdispersed noise and occasional negative
+corrections; deaths follow the cases two weeks later. A city only has rows
+from its first case on, and each state has an "Importados/Indefinidos" row
+without an IBGE code, as in the real data.
+"""
+
+import os
+import csv
+import gzip
+import argparse
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATES_PATH = os.path.join(ROOT, 'dados', 'states_ibge_codes.csv')
+COLUMNS = [
+    'city', 'city_ibge_code', 'date', 'epidemiological_week', 'estimated_population',
+    'estimated_population_2019', 'is_last', 'is_repeated', 'last_available_confirmed',
+    'last_available_confirmed_per_100k_inhabitants', 'last_available_date', 'last_available_death_rate',
+    'last_available_deaths', 'order_for_place', 'place_type', 'state', 'new_confirmed', 'new_deaths'
+]
+START = date(2020, 2, 25)
+# Number of cities of each state, 5570 in total
+CITY_COUNTS = {
+    'AC': 22, 'AL': 102, 'AP': 16, 'AM': 62, 'BA': 417, 'CE': 184, 'DF': 1, 'ES': 78, 'GO': 246,
+    'MA': 217, 'MT': 141, 'MS': 79, 'MG': 853, 'PA': 144, 'PB': 223, 'PR': 399, 'PE': 185, 'PI': 224,
+    'RJ': 92, 'RN': 167, 'RS': 497, 'RO': 52, 'RR': 15, 'SC': 295, 'SP': 645, 'SE': 75, 'TO': 139
+}
+# Reported cases by day of the week, Monday first, fewer on weekends
+WEEKDAY_FACTORS = np.array([0.9, 1.15, 1.15, 1.1, 1.1, 0.9, 0.7])
+PREFIXES = ['', '', '', 'São ', 'Santa ', 'Nova ', 'Bom ', 'Porto ', 'Campo ', 'Alto ', 'Santo ']
+SYLLABLES = ['ja', 'ra', 'ti', 'ba', 'cu', 'ma', 'pé', 'ça', 'ri', 'tá', 'po', 'gua', 'ne', 'lan', 'di', 'ú', 'ca', 'xo', 'ã', 'bi']
+
+def get_states():
+    """Returns a list of (label, IBGE code, abbreviation) of every state"""
+    with open(STATES_PATH, encoding='utf-8') as f:
+        return([(row['label'], int(row['value']), row['state']) for row in csv.DictReader(f)])
+
+def get_city_counts(states, cities):
+    """Returns the number of cities of each state, the real counts scaled to a total"""
+    real = np.array([CITY_COUNTS[abbr] for _, _, abbr in states], dtype='float64')
+    counts = np.maximum(np.floor(real / real.sum() * cities), 1).astype('int64')
+    # The rounding leftovers go to the largest states
+    for i in np.argsort(-real)[:max(cities - counts.sum(), 0)]:
+        counts[i] += 1
+    return(counts)
+
+def get_epidemiological_week(day):
+    """Returns the YYYYWW epidemiological week of a date, weeks run from Sunday and week 1 holds the 4th of January"""
+    def first_day(year):
+        jan4 = date(year, 1, 4)
+        return(jan4 - timedelta(days=(jan4.weekday() + 1) % 7))
+    year = day.year + 1 if day >= first_day(day.year + 1) else day.year
+    if(day < first_day(year)):
+        year -= 1
+    return(year * 100 + (day - first_day(year)).days // 7 + 1)
+
+def get_city_names(rng, n):
+    """Returns n distinct made-up city names, some with accents"""
+    names = []
+    seen = set()
+    while(len(names) < n):
+        # Accents never start a name, so they are all capitalized the same
+        word = rng.choice(SYLLABLES[:6]) + ''.join(rng.choice(SYLLABLES, rng.randint(1, 4)))
+        name = PREFIXES[rng.randint(len(PREFIXES))] + word[0].upper() + word[1:]
+        if(name not in seen):
+            seen.add(name)
+            names.append(name)
+    return(names)
+
+def get_cases(rng, populations, days, waves):
+    """Returns the new cases of places with given populations, one row per place and one column per day"""
+    t = np.arange(days, dtype='float64')
+    # Each place lives the waves a little earlier or later than the others
+    shift = rng.normal(0, 12, (len(populations), 1))
+    rate = np.zeros((len(populations), days))
+    for center, width, peak in waves:
+        amplitude = peak * rng.lognormal(0, 0.5, (len(populations), 1))
+        rate += amplitude * np.exp(-0.5 * ((t - center - shift) / width) ** 2)
+    weekdays = np.array([(START + timedelta(days=k)).weekday() for k in range(days)])
+    expected = rate * populations[:, None] / 100000 * WEEKDAY_FACTORS[weekdays]
+    # Gamma-Poisson, reported counts are much noisier than Poisson
+    cases = rng.poisson(rng.gamma(4, expected / 4 + 1e-9))
+    # A few days have negative corrections of earlier reports
+    totals = np.cumsum(cases, axis=1)
+    corrections = (rng.rand(*cases.shape) < 0.002) & (totals > 20)
+    cases[corrections] = -(totals[corrections] // 20)
+    return(cases)
+
+def get_deaths(rng, cases):
+    """Returns the new deaths of places, a share of their cases two weeks before"""
+    lagged = np.zeros_like(cases)
+    lagged[:, 14:] = np.maximum(cases[:, :-14], 0)
+    fatality = np.minimum(rng.lognormal(np.log(0.02), 0.3, (len(cases), 1)), 0.1)
+    return(rng.binomial(lagged, np.broadcast_to(fatality, lagged.shape)))
+
+def get_place_rows(places, cases, deaths, dates, weeks):
+    """Returns the rows of places from their first case on, as a dataframe"""
+    confirmed = np.cumsum(cases, axis=1)
+    total_deaths = np.cumsum(deaths, axis=1)
+    active = np.maximum.accumulate(confirmed > 0, axis=1)
+    rows = active.sum(axis=1)
+    columns = list(zip(*places))
+    # Missing codes and populations are written as empty fields
+    codes = np.array(['' if c is None else str(c) for c in columns[1]], dtype=object)
+    populations = np.array([p or np.nan for p in columns[4]], dtype='float64')
+    confirmed, total_deaths = confirmed[active], total_deaths[active]
+    population = np.repeat(populations, rows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_100k = np.round(confirmed / population * 100000, 5)
+        death_rate = np.round(np.where(confirmed > 0, total_deaths / confirmed, 0), 4)
+    day = np.broadcast_to(dates, cases.shape)[active]
+    last = np.zeros(cases.shape, dtype=bool)
+    last[:, -1] = True
+    return(pd.DataFrame({
+        'city': np.repeat(np.array(columns[0], dtype=object), rows),
+        'city_ibge_code': np.repeat(codes, rows),
+        'date': day,
+        'epidemiological_week': np.broadcast_to(weeks, cases.shape)[active],
+        'estimated_population': np.repeat(np.array([p or '' for p in columns[4]], dtype=object), rows),
+        'estimated_population_2019': np.repeat(np.array([p or '' for p in columns[4]], dtype=object), rows),
+        'is_last': last[active],
+        'is_repeated': False,
+        'last_available_confirmed': confirmed,
+        'last_available_confirmed_per_100k_inhabitants': per_100k,
+        'last_available_date': day,
+        'last_available_death_rate': death_rate,
+        'last_available_deaths': total_deaths,
+        'order_for_place': np.cumsum(active, axis=1)[active],
+        'place_type': np.repeat(np.array(columns[2], dtype=object), rows),
+        'state': np.repeat(np.array(columns[3], dtype=object), rows),
+        'new_confirmed': cases[active],
+        'new_deaths': deaths[active],
+    }))
+
+def write_dataset(path, cities=5570, days=600, seed=0):
+    """Writes a synthetic dataset with a number of cities spread over the states and a number of days"""
+    rng = np.random.RandomState(seed)
+    states = get_states()
+    dates = np.array([(START + timedelta(days=k)).isoformat() for k in range(days)], dtype=object)
+    weeks = np.array([get_epidemiological_week(START + timedelta(days=k)) for k in range(days)])
+    # One wave about every eight months, the first ones the largest
+    waves = [(center, rng.uniform(35, 60), 25 / (1 + i) ** 0.5 * rng.uniform(0.7, 1.3))
+             for i, center in enumerate(range(110, days + 60, 240))]
+    # Fast compression, writing is the slow part of large datasets
+    with gzip.open(path, 'wt', newline='', encoding='utf-8', compresslevel=1) as f:
+        header = True
+        for (_, code, abbr), n in zip(states, get_city_counts(states, cities)):
+            populations = np.maximum(rng.lognormal(np.log(11000), 1.1, n), 800).astype('int64')
+            names = get_city_names(rng, n)
+            places = [(names[i], code * 100000 + 10 * (i + 1), 'city', abbr, int(populations[i])) for i in range(n)]
+            state_waves = [(center + rng.normal(0, 20), width, peak) for center, width, peak in waves]
+            cases = get_cases(rng, populations, days, state_waves)
+            # Cases without a known city, counted in the state only
+            unknown = rng.poisson(0.02 * np.maximum(cases.sum(axis=0), 0) + 0.1)[None, :]
+            # Places without any case would have no rows
+            cases[cases.sum(axis=1) <= 0, -1] = 1
+            deaths = get_deaths(rng, cases)
+            unknown_deaths = get_deaths(rng, unknown)
+            state_cases = cases.sum(axis=0)[None, :] + unknown
+            state_deaths = deaths.sum(axis=0)[None, :] + unknown_deaths
+            rows = [
+                get_place_rows([('', code, 'state', abbr, int(populations.sum()))], state_cases, state_deaths, dates, weeks),
+                get_place_rows(places, cases, deaths, dates, weeks),
+                get_place_rows([('Importados/Indefinidos', None, 'city', abbr, None)], unknown, unknown_deaths, dates, weeks),
+            ]
+            for frame in rows:
+                frame.to_csv(f, header=header, index=False, columns=COLUMNS)
+                header = False
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Writes a synthetic caso_full.csv.gz dataset')
+    parser.add_argument('output', help='file to write, e.g. caso_full.csv.gz')
+    parser.add_argument('--cities', type=int, default=5570, help='number of cities, spread over the states as the real ones')
+    parser.add_argument('--days', type=int, default=600, help='number of days since {}'.format(START))
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator, the same seed writes the same file')
+    return(parser.parse_args())
+
+if __name__ == '__main__':
+    args = parse_args()
+    write_dataset(args.output, args.cities, args.days, args.seed)
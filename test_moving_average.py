@@ -0,0 +1,61 @@
+"""Checks the vectorized moving average against the original loop, run with python -m pytest"""
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+import synthetic_data
+
+# Importing the app loads a dataset, a small synthetic one keeps the tests offline
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix='brashboard-test-')
+synthetic_data.write_dataset(os.path.join(DATA_DIR, 'caso_full.csv.gz'), cities=20, days=30)
+os.environ['BRASHBOARD_DATA_URL'] = os.path.join(DATA_DIR, 'caso_full.csv.gz')
+os.environ['BRASHBOARD_CACHE_DIR'] = os.path.join(DATA_DIR, 'cache')
+os.environ['BRASHBOARD_REFRESH_INTERVAL'] = '0'
+os.environ['BRASHBOARD_WARMUP_PLACES'] = '0'
+
+import application
+from benchmarks import loop_moving_average
+
+WINDOW = application.MAVG_WINDOW
+
+def get_expected(data, window):
+    """Returns the loop moving average as floats, a window with nulls only as NaN"""
+    return(np.array([np.nan if value is pd.NA else value for value in loop_moving_average(data, window)], dtype='float64'))
+
+def get_series(rows, nulls=0.0, seed=0):
+    """Returns a series of daily counts as the dataset stores them, some of them null"""
+    rng = np.random.RandomState(seed)
+    return(pd.Series(rng.poisson(50, rows), dtype='Int32').mask(rng.rand(rows) < nulls))
+
+@pytest.mark.parametrize('rows', [0, 1, WINDOW - 1, WINDOW, WINDOW + 1, 100])
+def test_series(rows):
+    data = get_series(rows)
+    np.testing.assert_allclose(application.moving_average(data, WINDOW), get_expected(data, WINDOW))
+
+def test_nulls():
+    data = get_series(100, nulls=0.2)
+    # A whole window of nulls, and nulls at the tail
+    data[40:40 + WINDOW] = pd.NA
+    data[-3:] = pd.NA
+    result = application.moving_average(data, WINDOW)
+    np.testing.assert_allclose(result, get_expected(data, WINDOW))
+    assert np.isnan(result[40]) and np.isnan(result[-1])
+
+def test_batched():
+    df = pd.DataFrame({'new_confirmed': get_series(50, nulls=0.1, seed=1), 'new_deaths': get_series(50, nulls=0.1, seed=2)})
+    result = application.moving_average(df, WINDOW)
+    assert result.shape == (50, 2)
+    for i, col in enumerate(df):
+        np.testing.assert_allclose(result[:, i], get_expected(df[col], WINDOW))
+    # A plain 2D array averages its columns the same way
+    np.testing.assert_allclose(application.moving_average(df.astype('float64').to_numpy(), WINDOW), result)
+
+def test_stops():
+    # Places shorter than, as long as and longer than the window, stacked in one array
+    series = [get_series(rows, nulls=0.1, seed=rows) for rows in (1, WINDOW - 1, WINDOW, WINDOW + 1, 30)]
+    lengths = np.array([len(data) for data in series])
+    stops = np.cumsum(lengths)
+    result = application.moving_average(pd.concat(series, ignore_index=True), WINDOW, stops=np.repeat(stops, lengths))
+    np.testing.assert_allclose(result, np.concatenate([get_expected(data, WINDOW) for data in series]))